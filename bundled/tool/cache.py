@@ -0,0 +1,192 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Caches for formatting results."""
+
+from __future__ import annotations
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+
+class FormatCache:
+    """In-memory LRU cache of formatted content, bounded by total size in bytes."""
+
+    def __init__(self, max_bytes: int = 0):
+        self._entries: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self) -> int:
+        """Maximum total size of cached content; zero disables the cache."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int) -> None:
+        with self._lock:
+            self._max_bytes = max(value, 0)
+            self._evict()
+
+    @property
+    def size(self) -> int:
+        """Total size of cached content in bytes."""
+        return self._size
+
+    def get(self, key: str) -> bytes | None:
+        """Returns cached content for the given key, or None if not cached."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        """Stores content for the given key, evicting least recently used entries."""
+        cost = len(key) + len(value)
+        with self._lock:
+            if cost > self._max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(key) + len(previous)
+            self._entries[key] = value
+            self._size += cost
+            self._evict()
+
+    def clear(self) -> None:
+        """Drops all cached content."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self) -> None:
+        while self._entries and self._size > self._max_bytes:
+            key, value = self._entries.popitem(last=False)
+            self._size -= len(key) + len(value)
+
+
+class DiskFormatCache:
+    """On-disk LRU cache of formatted content, bounded by total size in bytes.
+
+    Results are kept in a SQLite database, so several servers, such as one per
+    VS Code window, can share them and they survive restarts. SQLite locking
+    makes concurrent reads and writes from separate processes safe. Errors
+    from the database are treated as cache misses, since formatting can
+    always fall back to running the tools.
+    """
+
+    # Eviction scans the whole table, so only check the size every few writes.
+    EVICT_INTERVAL = 32
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self._max_bytes = max(max_bytes, 0)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            # Write-ahead logging lets readers in other servers carry on while
+            # one of them writes.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+            self._evict()
+
+    @property
+    def max_bytes(self) -> int:
+        """Maximum total size of cached content."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value: int) -> None:
+        with self._lock:
+            self._max_bytes = max(value, 0)
+            self._evict()
+
+    def get(self, key: str) -> bytes | None:
+        """Returns cached content for the given key, or None if not cached."""
+        with self._lock:
+            try:
+                row = self._connection.execute(
+                    "SELECT value FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE results SET accessed = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key: str, value: bytes) -> None:
+        """Stores content for the given key, evicting least recently used entries."""
+        cost = len(key) + len(value)
+        with self._lock:
+            if cost > self._max_bytes:
+                return
+            try:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (key, value, cost, time.time()),
+                )
+                self._puts += 1
+                if self._puts % self.EVICT_INTERVAL == 0:
+                    self._evict()
+            except sqlite3.Error:
+                pass
+
+    def close(self) -> None:
+        """Closes the database."""
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        try:
+            (size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+            if size <= self._max_bytes:
+                return
+            # Drop the least recently used entries that take the size over the
+            # limit in one statement, so other servers never see a partial
+            # eviction.
+            self._connection.execute(
+                "DELETE FROM results WHERE key IN ("
+                " SELECT key FROM ("
+                "  SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total"
+                "  FROM results"
+                " ) WHERE total > ?"
+                ")",
+                (self._max_bytes,),
+            )
+        except sqlite3.Error:
+            pass
@@ -6,16 +6,31 @@
 import atexit
 import io
 import json
+import os
 import pathlib
+import queue
 import subprocess
 import threading
+import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from typing import BinaryIO, Dict, Sequence, Union
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import BinaryIO, Dict, List, Sequence, Tuple, Union
 
 CONTENT_LENGTH = "Content-Length: "
+PAYLOAD_LENGTH = "Payload-Length: "
+PAYLOAD_NAME = "Payload-Name: "
 RUNNER_SCRIPT = str(pathlib.Path(__file__).parent / "runner.py")
 
+# Protocol versions: version 1 sends each message as a single JSON document,
+# while version 2 sends the document source or formatted result as raw UTF-8
+# bytes after the JSON header, so it is never escaped into a JSON string.
+JSON_PROTOCOL = 1
+BINARY_PROTOCOL = 2
+PROTOCOL_VERSIONS = (BINARY_PROTOCOL, JSON_PROTOCOL)
+# Message fields that are sent as the payload under the binary protocol.
+PAYLOAD_FIELDS = ("source", "result")
+
 
 def to_str(text) -> str:
     """Convert bytes to string as needed."""
@@ -34,6 +49,7 @@ class JsonWriter:
     def __init__(self, writer: io.TextIOWrapper):
         self._writer = writer
         self._lock = threading.Lock()
+        self.protocol = JSON_PROTOCOL
 
     def close(self):
         """Closes the underlying writer stream."""
@@ -46,12 +62,34 @@ class JsonWriter:
         if self._writer.closed:
             raise StreamClosedException()
 
+        name = next(
+            (
+                field
+                for field in PAYLOAD_FIELDS
+                if isinstance(data.get(field), (str, bytes))
+            ),
+            None,
+        )
+        if name is None:
+            headers, payload = "", b""
+        elif self.protocol >= BINARY_PROTOCOL:
+            payload = data[name]
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            data = {key: value for key, value in data.items() if key != name}
+            headers = f"{PAYLOAD_LENGTH}{len(payload)}\r\n{PAYLOAD_NAME}{name}\r\n"
+        else:
+            headers, payload = "", b""
+            data = {**data, name: to_str(data[name])}
+
+        content = json.dumps(data).encode("utf-8")
         with self._lock:
-            content = json.dumps(data)
-            length = len(content.encode("utf-8"))
             self._writer.write(
-                f"{CONTENT_LENGTH}{length}\r\n\r\n{content}".encode("utf-8")
+                f"{CONTENT_LENGTH}{len(content)}\r\n{headers}\r\n".encode("utf-8")
             )
+            self._writer.write(content)
+            if payload:
+                self._writer.write(payload)
             self._writer.flush()
 
 
@@ -67,7 +105,11 @@ class JsonReader:
             self._reader.close()
 
     def read(self):
-        """Reads data from the stream in JSON-RPC format."""
+        """Reads data from the stream in JSON-RPC format.
+
+        Messages of either protocol version are accepted. A binary payload is
+        returned as bytes under the field it was sent for.
+        """
         if self._reader.closed:
             raise StreamClosedException
         length = None
@@ -76,12 +118,19 @@ class JsonReader:
             if line.startswith(CONTENT_LENGTH):
                 length = int(line[len(CONTENT_LENGTH) :])
 
+        payload_length, payload_name = 0, None
         line = to_str(self._readline()).strip()
         while line:
+            if line.startswith(PAYLOAD_LENGTH):
+                payload_length = int(line[len(PAYLOAD_LENGTH) :])
+            elif line.startswith(PAYLOAD_NAME):
+                payload_name = line[len(PAYLOAD_NAME) :]
             line = to_str(self._readline()).strip()
 
-        content = to_str(self._reader.read(length))
-        return json.loads(content)
+        data = json.loads(self._reader.read(length))
+        if payload_name is not None:
+            data[payload_name] = self._reader.read(payload_length)
+        return data
 
     def _readline(self):
         line = self._reader.readline()
@@ -91,11 +140,22 @@ class JsonReader:
 
 
 class JsonRpc:
-    """Manages sending and receiving data over JSON-RPC."""
+    """Manages sending and receiving data over JSON-RPC.
+
+    Requests sent with `send_request` can be in flight together: a reader
+    thread, started with the first request, hands each response to the future
+    of the request with the same id. Responses marked partial go to the
+    request's `on_partial` callback instead, ahead of its final response.
+    """
 
     def __init__(self, reader: io.TextIOWrapper, writer: io.TextIOWrapper):
         self._reader = JsonReader(reader)
         self._writer = JsonWriter(writer)
+        self._pending: Dict[str, Future] = {}
+        self._partial_handlers: Dict[str, Callable[[dict], None]] = {}
+        self._lock = threading.Lock()
+        self._reader_thread: Union[threading.Thread, None] = None
+        self._closed = False
 
     def close(self):
         """Closes the underlying streams."""
@@ -107,6 +167,42 @@ class JsonRpc:
             self._writer.close()
         except:  # pylint: disable=bare-except
             pass
+        self._fail_pending(StreamClosedException())
+
+    @property
+    def protocol(self) -> int:
+        """The protocol version used to send messages."""
+        return self._writer.protocol
+
+    @protocol.setter
+    def protocol(self, version: int) -> None:
+        self._writer.protocol = version
+
+    def negotiate_protocol(self) -> Future:
+        """Offers the supported protocol versions to the other end.
+
+        Messages are sent as JSON until the other end picks a version, so this
+        does not wait for the response. Returns a future for the version used.
+        """
+        future = self.send_request(
+            {
+                "id": str(uuid.uuid4()),
+                "method": "negotiate",
+                "versions": list(PROTOCOL_VERSIONS),
+            }
+        )
+        negotiated = Future()
+
+        def _use_version(response: Future):
+            version = JSON_PROTOCOL
+            if not response.exception():
+                version = response.result().get("version", JSON_PROTOCOL)
+                if version in PROTOCOL_VERSIONS:
+                    self.protocol = version
+            negotiated.set_result(self.protocol)
+
+        future.add_done_callback(_use_version)
+        return negotiated
 
     def send_data(self, data):
         """Send given data in JSON-RPC format."""
@@ -116,85 +212,407 @@ class JsonRpc:
         """Receive data in JSON-RPC format."""
         return self._reader.read()
 
+    def send_request(
+        self, data, on_partial: Union[Callable[[dict], None], None] = None
+    ) -> Future:
+        """Sends a request, returning a future for the response with its id.
+
+        Partial responses are passed to `on_partial` on the reader thread.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise StreamClosedException()
+            self._pending[data["id"]] = future
+            if on_partial is not None:
+                self._partial_handlers[data["id"]] = on_partial
+            if self._reader_thread is None:
+                self._reader_thread = threading.Thread(
+                    target=self._read_responses, name="json-rpc-reader", daemon=True
+                )
+                self._reader_thread.start()
+        try:
+            self.send_data(data)
+        except Exception:
+            with self._lock:
+                self._pending.pop(data["id"], None)
+                self._partial_handlers.pop(data["id"], None)
+            raise
+        return future
+
+    def _read_responses(self):
+        try:
+            while True:
+                data = self.receive_data()
+                if data.get("partial"):
+                    with self._lock:
+                        on_partial = self._partial_handlers.get(data.get("id"))
+                    if on_partial is not None:
+                        on_partial(data)
+                    continue
+                with self._lock:
+                    future = self._pending.pop(data.get("id"), None)
+                    self._partial_handlers.pop(data.get("id"), None)
+                if future is not None:
+                    future.set_result(data)
+        except Exception as e:  # pylint: disable=broad-except
+            self._fail_pending(e)
+
+    def _fail_pending(self, exception: Exception):
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._partial_handlers.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(exception)
+
 
 def create_json_rpc(readable: BinaryIO, writable: BinaryIO) -> JsonRpc:
     """Creates JSON-RPC wrapper for the readable and writable streams."""
     return JsonRpc(readable, writable)
 
 
+# Number of runner processes kept, and started at most, for each interpreter.
+DEFAULT_MIN_RUNNERS = 1
+DEFAULT_MAX_RUNNERS = 2
+# Seconds a runner beyond the minimum may stay idle before it is stopped.
+RUNNER_IDLE_TIMEOUT = 300.0
+
+
+RunnerKey = Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]]
+
+
+class RunnerStartError(Exception):
+    """A runner process could not import the tools."""
+
+
+class Runner:
+    """A runner process and the JSON-RPC connection to it.
+
+    `ready` resolves to the versions of the tools once the runner has imported
+    them, or fails with `RunnerStartError` if it could not. A retiring runner
+    gets no new requests once another is ready, and stops when drained.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        proc: subprocess.Popen,
+        rpc: JsonRpc,
+        key: RunnerKey,
+        cwd: str,
+        env: Union[Dict[str, str], None],
+    ):
+        self.proc = proc
+        self.rpc = rpc
+        self.key = key
+        self.cwd = cwd
+        self.env = env
+        self.in_flight = 0
+        self.requests = 0
+        self.rss = 0
+        self.retiring = False
+        self.last_used = time.monotonic()
+        self.ready: Future = Future()
+
+    def start_handshake(self) -> None:
+        """Asks the runner to import the tools and report their versions."""
+        self.rpc.negotiate_protocol()
+        response = self.rpc.send_request({"id": str(uuid.uuid4()), "method": "ready"})
+
+        def _set_ready(future: Future):
+            if future.exception():
+                self.ready.set_exception(RunnerStartError(str(future.exception())))
+            elif "error" in future.result():
+                self.ready.set_exception(RunnerStartError(future.result()["error"]))
+            else:
+                self.ready.set_result(future.result().get("versions", {}))
+
+        response.add_done_callback(_set_ready)
+
+    def is_ready(self) -> bool:
+        """Whether the runner has imported the tools."""
+        return self.ready.done() and not self.ready.exception()
+
+    def stop(self):
+        """Send exit command to the process and close the connection."""
+        try:
+            self.rpc.send_data({"id": str(uuid.uuid4()), "method": "exit"})
+        except:  # pylint: disable=bare-except
+            pass
+        self.rpc.close()
+
+
 class ProcessManager:
-    """Manages sub-processes launched for running tools."""
+    """Manages sub-processes launched for running tools.
+
+    Runners are shared by every workspace using the same interpreter and
+    environment. Requests go to the ready runner with the fewest requests in
+    flight, and another runner is started, up to `max_runners`, when all are
+    busy. Runners beyond `min_runners` are stopped once idle for `idle_timeout`.
+
+    Runners that have handled `max_requests` requests, or report more than
+    `max_memory` bytes resident, are recycled: a replacement is started right
+    away, and the old runner keeps serving until the replacement is ready and
+    stops once its requests in flight finish. Zero disables either limit.
+    """
 
     def __init__(self):
-        self._args: Dict[str, Sequence[str]] = {}
-        self._processes: Dict[str, subprocess.Popen] = {}
-        self._rpc: Dict[str, JsonRpc] = {}
-        self._lock = threading.Lock()
-        self._thread_pool = ThreadPoolExecutor(10)
+        self._runners: Dict[RunnerKey, List[Runner]] = {}
+        self._recycled: Dict[RunnerKey, int] = {}
+        # Re-entrant, as ready callbacks may run while starting a runner.
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._reaper: Union[threading.Thread, None] = None
+        self.min_runners = DEFAULT_MIN_RUNNERS
+        self.max_runners = DEFAULT_MAX_RUNNERS
+        self.idle_timeout = RUNNER_IDLE_TIMEOUT
+        self.max_requests = 0
+        self.max_memory = 0
 
     def stop_all_processes(self):
         """Send exit command to all processes and shutdown transport."""
-        for i in self._rpc.values():
-            try:
-                i.send_data({"id": str(uuid.uuid4()), "method": "exit"})
-            except:  # pylint: disable=bare-except
-                pass
-        self._thread_pool.shutdown(wait=False)
-
-    def start_process(self, workspace: str, args: Sequence[str], cwd: str) -> None:
-        """Starts a process and establishes JSON-RPC communication over stdio."""
+        self._stopped.set()
+        with self._lock:
+            runners = [r for runners in self._runners.values() for r in runners]
+            self._runners.clear()
+        for runner in runners:
+            runner.stop()
+
+    def acquire(
+        self,
+        interpreter: Sequence[str],
+        cwd: str,
+        env: Union[Dict[str, str], None] = None,
+    ) -> Runner:
+        """Returns the least loaded ready runner for the interpreter.
+
+        Waits for a runner to become ready if none is. The request is counted
+        against the runner, so every call must be paired with `release()`.
+        Raises `RunnerStartError` if the runners fail to import the tools.
+        """
+        key = _runner_key(interpreter, env)
+        while True:
+            with self._lock:
+                runners = self._start_runners(key, cwd, env)
+                ready = [r for r in runners if r.is_ready()]
+                # Retiring runners only serve until a replacement is ready.
+                active = [r for r in ready if not r.retiring] or ready
+                runner = min(active, key=lambda r: r.in_flight, default=None)
+                starting = [r for r in runners if not r.ready.done()]
+                if runner is None or runner.in_flight:
+                    if not starting and _count_active(runners) < self.max_runners:
+                        starting.append(self._start_runner(key, cwd, env))
+                if runner is not None:
+                    runner.in_flight += 1
+                    runner.requests += 1
+                    return runner
+                if not starting:
+                    # Every runner failed its handshake and none can be added.
+                    raise runners[0].ready.exception()
+
+            wait([r.ready for r in starting], return_when=FIRST_COMPLETED)
+            for started in starting:
+                if started.ready.done() and started.ready.exception():
+                    raise started.ready.exception()
+
+    def start_runners(
+        self,
+        interpreter: Sequence[str],
+        cwd: str,
+        env: Union[Dict[str, str], None] = None,
+    ) -> None:
+        """Starts the minimum number of runners for the interpreter ahead of use."""
+        with self._lock:
+            self._start_runners(_runner_key(interpreter, env), cwd, env)
+
+    def stop_runners(self, interpreter: Sequence[str]) -> None:
+        """Stops every runner started with the interpreter."""
+        with self._lock:
+            stopped = [
+                runner
+                for key in list(self._runners)
+                if key[0] == tuple(interpreter)
+                for runner in self._runners.pop(key)
+            ]
+        for runner in stopped:
+            runner.stop()
+
+    def release(self, runner: Runner, rss: Union[int, None] = None) -> None:
+        """Counts the end of a request sent to a runner from `acquire()`.
+
+        `rss` is the resident memory the runner reported with its response,
+        if any. Starts recycling the runner if it is over either limit.
+        """
+        with self._lock:
+            runner.in_flight -= 1
+            runner.last_used = time.monotonic()
+            if rss:
+                runner.rss = rss
+            if not runner.retiring and self._is_worn_out(runner):
+                runner.retiring = True
+                self._recycled[runner.key] = self._recycled.get(runner.key, 0) + 1
+                if not self._stopped.is_set():
+                    # Start the replacement now, so it is warm when needed.
+                    self._start_runners(runner.key, runner.cwd, runner.env)
+            drained = self._take_drained(runner.key)
+        for stopped in drained:
+            stopped.stop()
+
+    def _is_worn_out(self, runner: Runner) -> bool:
+        return (0 < self.max_requests <= runner.requests) or (
+            0 < self.max_memory <= runner.rss
+        )
+
+    def _take_drained(self, key: RunnerKey) -> List[Runner]:
+        """Removes retiring runners with nothing in flight, once another is ready."""
+        runners = self._runners.get(key, [])
+        if not any(r.is_ready() and not r.retiring for r in runners):
+            return []
+        drained = [r for r in runners if r.retiring and not r.in_flight]
+        for runner in drained:
+            runners.remove(runner)
+        return drained
+
+    def runner_counts(self) -> Dict[str, dict]:
+        """Returns runner and request counts, and tool versions, by interpreter."""
+        with self._lock:
+            counts = {}
+            for key, runners in self._runners.items():
+                if not runners:
+                    continue
+                ready = [r for r in runners if r.is_ready()]
+                counts[" ".join(key[0])] = {
+                    "runners": len(runners),
+                    "ready": len(ready),
+                    "inFlight": sum(r.in_flight for r in runners),
+                    "recycled": self._recycled.get(key, 0),
+                    "versions": ready[0].ready.result() if ready else {},
+                }
+            return counts
+
+    def _start_runners(
+        self, key: RunnerKey, cwd: str, env: Union[Dict[str, str], None]
+    ) -> List[Runner]:
+        """Starts runners for the key up to the minimum, returning all of them."""
+        if self._stopped.is_set():
+            raise StreamClosedException()
+        runners = self._runners.setdefault(key, [])
+        while _count_active(runners) < max(self.min_runners, 1):
+            self._start_runner(key, cwd, env)
+        return runners
+
+    def _start_runner(
+        self, key: RunnerKey, cwd: str, env: Union[Dict[str, str], None]
+    ) -> Runner:
+        """Starts a runner and establishes JSON-RPC communication over stdio."""
+        interpreter, _ = key
         # pylint: disable=consider-using-with
         proc = subprocess.Popen(
-            args,
+            [*interpreter, RUNNER_SCRIPT],
             cwd=cwd,
+            env={**os.environ, **env} if env else None,
             stdout=subprocess.PIPE,
             stdin=subprocess.PIPE,
         )
-        self._processes[workspace] = proc
-        self._rpc[workspace] = create_json_rpc(proc.stdout, proc.stdin)
+        runner = Runner(proc, create_json_rpc(proc.stdout, proc.stdin), key, cwd, env)
+        self._runners[key].append(runner)
 
         def _monitor_process():
             proc.wait()
             with self._lock:
-                try:
-                    del self._processes[workspace]
-                    rpc = self._rpc.pop(workspace)
-                    rpc.close()
-                except:  # pylint: disable=bare-except
-                    pass
+                runners = self._runners.get(key, [])
+                if runner in runners:
+                    runners.remove(runner)
+            runner.rpc.close()
+
+        def _check_ready(ready: Future):
+            # A runner that can't import the tools never becomes usable, and
+            # the monitor removes it once it exits.
+            if ready.exception():
+                runner.stop()
+                return
+            # Retiring runners this one replaces can stop once drained.
+            with self._lock:
+                drained = self._take_drained(key)
+            for stopped in drained:
+                stopped.stop()
+
+        # Daemon threads, since executor threads would be joined on exit before
+        # `shutdown_json_rpc` gets to stop the processes they wait on.
+        threading.Thread(
+            target=_monitor_process, name="runner-monitor", daemon=True
+        ).start()
+        runner.start_handshake()
+        runner.ready.add_done_callback(_check_ready)
+        if self._reaper is None:
+            self._reaper = threading.Thread(
+                target=self._reap_idle_runners, name="runner-reaper", daemon=True
+            )
+            self._reaper.start()
+        return runner
+
+    def _reap_idle_runners(self):
+        while not self._stopped.wait(self.idle_timeout / 4):
+            now = time.monotonic()
+            idle = []
+            with self._lock:
+                for runners in self._runners.values():
+                    for runner in sorted(runners, key=lambda r: r.last_used):
+                        if len(runners) <= self.min_runners:
+                            break
+                        if (
+                            not runner.in_flight
+                            and now - runner.last_used > self.idle_timeout
+                        ):
+                            runners.remove(runner)
+                            idle.append(runner)
+            for runner in idle:
+                runner.stop()
 
-        self._thread_pool.submit(_monitor_process)
 
-    def get_json_rpc(self, workspace: str) -> JsonRpc:
-        """Gets the JSON-RPC wrapper for the a given id."""
-        with self._lock:
-            if workspace in self._rpc:
-                return self._rpc[workspace]
-        raise StreamClosedException()
+def _count_active(runners: List[Runner]) -> int:
+    return sum(not runner.retiring for runner in runners)
+
+
+def _runner_key(
+    interpreter: Sequence[str], env: Union[Dict[str, str], None]
+) -> RunnerKey:
+    return (tuple(interpreter), tuple(sorted((env or {}).items())))
 
 
 _process_manager = ProcessManager()
 
 
-def _get_json_rpc(workspace: str) -> Union[JsonRpc, None]:
-    try:
-        return _process_manager.get_json_rpc(workspace)
-    except StreamClosedException:
-        return None
-    except KeyError:
-        return None
+def configure_runners(
+    min_runners: int, max_runners: int, max_requests: int = 0, max_memory: int = 0
+) -> None:
+    """Sets how many runners each interpreter gets, and when they are recycled.
+
+    Runners are recycled after `max_requests` requests, or once more than
+    `max_memory` bytes are resident. Zero disables either limit.
+    """
+    _process_manager.min_runners = max(min_runners, 0)
+    _process_manager.max_runners = max(max_runners, min_runners, 1)
+    _process_manager.max_requests = max(max_requests, 0)
+    _process_manager.max_memory = max(max_memory, 0)
+
 
+def start_runners(interpreter: Sequence[str], cwd: str) -> None:
+    """Starts runners for an interpreter, so they are ready before first use."""
+    _process_manager.start_runners(interpreter, cwd)
 
-def get_or_start_json_rpc(
-    workspace: str, interpreter: Sequence[str], cwd: str
-) -> Union[JsonRpc, None]:
-    """Gets an existing JSON-RPC connection or starts one and return it."""
-    res = _get_json_rpc(workspace)
-    if not res:
-        args = [*interpreter, RUNNER_SCRIPT]
-        _process_manager.start_process(workspace, args, cwd)
-        res = _get_json_rpc(workspace)
-    return res
+
+def stop_runners(interpreter: Sequence[str]) -> None:
+    """Stops the runners for an interpreter that is no longer used."""
+    _process_manager.stop_runners(interpreter)
+
+
+def runner_counts() -> Dict[str, dict]:
+    """Returns runner and request counts, and tool versions, by interpreter."""
+    return _process_manager.runner_counts()
 
 
 class RpcRunResult:
@@ -211,43 +629,93 @@ def run_over_json_rpc(
     workspace: str,
     interpreter: Sequence[str],
     module: str,
-    argv: Sequence[str],
-    use_stdin: bool,
     cwd: str,
-    source: str = None,
+    document_path: str,
+    source: str,
 ) -> RpcRunResult:
-    """Uses JSON-RPC to execute a command."""
-    rpc: Union[JsonRpc, None] = get_or_start_json_rpc(workspace, interpreter, cwd)
-    if not rpc:
-        raise Exception("Failed to run over JSON-RPC.")
+    """Uses JSON-RPC to format a document.
 
-    msg_id = str(uuid.uuid4())
+    Several threads can call this at once: their requests are pipelined over
+    the runners for the interpreter, and each gets the response to its own
+    request. Runners are shared by workspaces, so `workspace` is unused.
+    """
+    try:
+        runner = _process_manager.acquire(interpreter, cwd)
+    except RunnerStartError as e:
+        return RpcRunResult("", "", str(e))
     msg = {
-        "id": msg_id,
+        "id": str(uuid.uuid4()),
         "method": "run",
         "module": module,
-        "argv": argv,
-        "useStdin": use_stdin,
         "cwd": cwd,
+        "document_path": document_path,
+        "source": source,
     }
-    if source:
-        msg["source"] = source
-
-    rpc.send_data(msg)
-
-    data = rpc.receive_data()
+    data = {}
+    try:
+        data = runner.rpc.send_request(msg).result()
+    finally:
+        _process_manager.release(runner, data.get("rss"))
+    return _get_run_result(data)
 
-    if data["id"] != msg_id:
-        return RpcRunResult(
-            "", f"Invalid result for request: {json.dumps(msg, indent=4)}"
-        )
 
+def _get_run_result(data: dict) -> RpcRunResult:
     if "error" in data:
         if data.get("exception", False):
-            return RpcRunResult(data["result"], "", data["error"])
-        return RpcRunResult(data["result"], data["error"])
+            return RpcRunResult("", "", data["error"])
+        return RpcRunResult("", data["error"])
+    return RpcRunResult(to_str(data.get("result", "")), "")
+
+
+def run_batch_over_json_rpc(
+    interpreter: Sequence[str],
+    module: str,
+    cwd: str,
+    documents: Sequence[Tuple[str, str]],
+) -> Iterator[Tuple[int, RpcRunResult]]:
+    """Uses JSON-RPC to format several documents in one request.
+
+    Documents are given as (document_path, source) pairs. Yields the index of
+    each document with its result, in the order the runner finishes them.
+    """
+    try:
+        runner = _process_manager.acquire(interpreter, cwd)
+    except RunnerStartError as e:
+        for index in range(len(documents)):
+            yield index, RpcRunResult("", "", str(e))
+        return
 
-    return RpcRunResult(data["result"], "")
+    msg = {
+        "id": str(uuid.uuid4()),
+        "method": "runBatch",
+        "module": module,
+        "cwd": cwd,
+        "documents": [
+            {"document_path": document_path, "source": source}
+            for document_path, source in documents
+        ],
+    }
+    results: queue.Queue = queue.Queue()
+    done = None
+    try:
+        done = runner.rpc.send_request(msg, on_partial=results.put)
+        done.add_done_callback(lambda _: results.put(None))
+        remaining = set(range(len(documents)))
+        while remaining:
+            data = results.get()
+            if data is None:
+                break
+            remaining.discard(data["index"])
+            yield data["index"], _get_run_result(data)
+        # Documents the runner never answered for failed with the request.
+        error = done.exception() if done.done() else None
+        for index in sorted(remaining):
+            yield index, RpcRunResult("", "", str(error or "no result"))
+    finally:
+        rss = None
+        if done is not None and done.done() and not done.exception():
+            rss = done.result().get("rss")
+        _process_manager.release(runner, rss)
 
 
 @atexit.register
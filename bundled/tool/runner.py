@@ -4,6 +4,8 @@
 Runner to use when running under a different interpreter.
 """
 
+import dataclasses
+import importlib.metadata
 import os
 import pathlib
 import sys
@@ -30,10 +32,129 @@ update_sys_path(
 
 
 # pylint: disable=wrong-import-position,import-error
-from . import jsonrpc, utils
+import jsonrpc
+import utils
 
 RPC = jsonrpc.create_json_rpc(sys.stdin.buffer, sys.stdout.buffer)
 
+
+def import_ufmt():
+    """Imports ufmt, checking it is a version the runner supports."""
+    import ufmt
+    import ufmt.util
+
+    if ufmt.__version__.startswith("1."):
+        raise RuntimeError("Requires ufmt >= 2.0.0b1")
+    return ufmt
+
+
+def get_config_key(document_path: pathlib.Path):
+    """Returns where black and usort read config for the document from.
+
+    usort reads the nearest pyproject.toml, while black stops at the project
+    root, so documents with the same pair share their configs. Returns None
+    if they can't be found, and the document's configs are resolved alone.
+    """
+    try:
+        from black.files import find_pyproject_toml
+
+        black_config_file = find_pyproject_toml((str(document_path),))
+    except Exception:  # pylint: disable=broad-except
+        return None
+    for directory in document_path.parents:
+        if (directory / "pyproject.toml").is_file():
+            return black_config_file, directory
+    return black_config_file, None
+
+
+def run_ufmt(document_path, source, black_config, usort_config):
+    """Formats a source, returning the result and whether formatting raised."""
+    try:
+        ufmt = import_ufmt()
+        source_bytes = source
+        if isinstance(source_bytes, str):
+            source_bytes = source_bytes.encode("utf-8")
+        if black_config is None:
+            black_config = ufmt.util.make_black_config(document_path)
+        if usort_config is None:
+            usort_config = ufmt.types.UsortConfig.find(document_path)
+        os.environ["LIBCST_PARSER_TYPE"] = "native"
+        ufmt_result = ufmt.ufmt_bytes(
+            document_path,
+            source_bytes,
+            encoding="utf-8",
+            black_config=black_config,
+            usort_config=usort_config,
+        )
+        return utils.RunResult(ufmt_result, ""), False
+    except Exception:  # pylint: disable=broad-except
+        return utils.RunResult("", traceback.format_exc(chain=True)), True
+
+
+def make_response(response, result, is_exception):
+    """Adds the result, or the error, of formatting a document to a response."""
+    if result.stderr:
+        response["error"] = result.stderr
+        response["exception"] = is_exception
+    elif result.stdout:
+        response["result"] = result.stdout
+    return response
+
+
+def run_batch(msg):
+    """Formats the documents of a runBatch request, streaming their results.
+
+    Each result is sent as soon as it is ready, in a partial response with the
+    index of its document, followed by a final response once all are done.
+    Documents are grouped by config root, so black and usort configs are
+    resolved once per group rather than once per document.
+    """
+    groups = {}
+    for index, document in enumerate(msg["documents"]):
+        document_path = pathlib.Path(document["document_path"]).resolve()
+        key = get_config_key(document_path)
+        # Documents without a known key are each a group of their own.
+        groups.setdefault((index,) if key is None else key, []).append(
+            (index, document_path, document["source"])
+        )
+
+    for documents in groups.values():
+        black_config = usort_config = None
+        if len(documents) > 1:
+            try:
+                ufmt = import_ufmt()
+                # usort infers first-party names from each document's path,
+                # so only the config from pyproject.toml is shared.
+                black_config = ufmt.util.make_black_config(documents[0][1])
+                usort_config = ufmt.types.UsortConfig.find(
+                    documents[0][1], with_first_party=False
+                )
+            except Exception:  # pylint: disable=broad-except
+                # Each document reports the error when resolving it again.
+                black_config = usort_config = None
+
+        for index, document_path, source in documents:
+            document_usort_config = usort_config
+            if usort_config is not None and usort_config.first_party_detection:
+                # with_first_party updates the config in place, so each
+                # document gets its own copy of the known names.
+                document_usort_config = dataclasses.replace(
+                    usort_config, known=dict(usort_config.known)
+                ).with_first_party(document_path)
+            result, is_exception = run_ufmt(
+                document_path, source, black_config, document_usort_config
+            )
+            RPC.send_data(
+                make_response(
+                    {"id": msg["id"], "partial": True, "index": index},
+                    result,
+                    is_exception,
+                )
+            )
+
+    RPC.send_data({"id": msg["id"], "rss": utils.get_rss()})
+
+
 EXIT_NOW = False
 while not EXIT_NOW:
     msg = RPC.receive_data()
@@ -43,35 +164,52 @@ while not EXIT_NOW:
         EXIT_NOW = True
         continue
 
-    if method == "run":
-        is_exception = False
-        # This is needed to preserve sys.path, pylint modifies
-        # sys.path and that might not work for this scenario
-        # next time around.
+    if method == "negotiate":
+        # Answer in the current protocol, then send everything else in the
+        # newest version both ends support.
+        version = max(
+            set(msg.get("versions", [])) & set(jsonrpc.PROTOCOL_VERSIONS),
+            default=jsonrpc.JSON_PROTOCOL,
+        )
+        RPC.send_data({"id": msg["id"], "version": version})
+        RPC.protocol = version
+        continue
+
+    if method == "ready":
+        # Import the tools up front, so formatting requests never wait on them.
+        response = {"id": msg["id"]}
         with utils.substitute_attr(sys, "path", sys.path[:]):
             try:
+                # pylint: disable=unused-import
+                import black
+                import libcst
                 import ufmt
-                import ufmt.util
-
-                if ufmt.__version__.startswith("1."):
-                    raise RuntimeError("Requires ufmt >= 2.0.0b1")
-
-                document_path = pathlib.Path(msg["document_path"]).resolve()
-                source_bytes = msg["source"].encode("utf-8")
-                black_config = ufmt.util.make_black_config(document_path)
-                usort_config = ufmt.types.UsortConfig.find(document_path)
-                os.environ['LIBCST_PARSER_TYPE'] = 'native'
-                ufmt_result = ufmt.ufmt_bytes(document_path, source_bytes, encoding="utf-8", black_config=black_config, usort_config=usort_config,)
-                result = utils.RunResult(ufmt_result.decode("utf-8"), "")
+                import usort
+
+                response["versions"] = {
+                    name: importlib.metadata.version(name)
+                    for name in ("ufmt", "black", "usort", "libcst")
+                }
             except Exception:  # pylint: disable=broad-except
-                result = utils.RunResult("", traceback.format_exc(chain=True))
-                is_exception = True
+                response["error"] = traceback.format_exc(chain=True)
+        RPC.send_data(response)
+        continue
 
-        response = {"id": msg["id"]}
-        if result.stderr:
-            response["error"] = result.stderr
-            response["exception"] = is_exception
-        elif result.stdout:
-            response["result"] = result.stdout
+    if method == "run":
+        # This is needed to preserve sys.path, pylint modifies
+        # sys.path and that might not work for this scenario
+        # next time around.
+        with utils.substitute_attr(sys, "path", sys.path[:]):
+            result, is_exception = run_ufmt(
+                pathlib.Path(msg["document_path"]).resolve(), msg["source"], None, None
+            )
 
+        response = make_response({"id": msg["id"]}, result, is_exception)
+        # The server recycles runners that grow too large.
+        response["rss"] = utils.get_rss()
         RPC.send_data(response)
+        continue
+
+    if method == "runBatch":
+        with utils.substitute_attr(sys, "path", sys.path[:]):
+            run_batch(msg)
@@ -4,14 +4,26 @@
 
 from __future__ import annotations
 
+import concurrent.futures
 import contextlib
-import copy
+import dataclasses
+import difflib
+import functools
+import gc
+import hashlib
 import importlib
+import io
 import json
+import multiprocessing
 import os
 import pathlib
+import re
 import sys
+import threading
+import time
 import traceback
+import types
+import uuid
 
 BUNDLED_LIBS = os.fspath(pathlib.Path(__file__).parent.parent / "libs")
 IMPORT_STRATEGY = os.getenv("LS_IMPORT_STRATEGY", "useBundled")
@@ -37,6 +49,8 @@ def update_sys_path(path_to_add: str, strategy: str) -> None:
             sys.path.append(path_to_add)
         yield
         sys.path.remove(path_to_add)
+    else:
+        yield
 
 
 # **********************************************************
@@ -44,19 +58,110 @@ def update_sys_path(path_to_add: str, strategy: str) -> None:
 # **********************************************************
 # Ensure that we can import LSP libraries, and other bundled libraries.
 with update_sys_path(BUNDLED_LIBS, "useBundled"):
+    import cache
     import jsonrpc
     import lsprotocol.types as lsp
+    import stats
     import utils
-    from pygls import protocol, server, uris, workspace
-
-WORKSPACE_SETTINGS = {}
+    import worker
+    from pygls import feature_manager, protocol, server, uris, workspace
+    from pygls.exceptions import JsonRpcRequestCancelled
+
+WORKSPACE_SETTINGS: dict[str, types.MappingProxyType] = {}
+# Settings for the directories of documents seen so far, cleared when
+# settings change.
+SETTINGS_BY_DIRECTORY: dict[str, types.MappingProxyType] = {}
+SETTINGS_LOCK = threading.Lock()
+FORMAT_CACHE = cache.FormatCache()
+# Results of the sort and format stages, kept apart from whole-document results.
+STAGE_CACHE = cache.FormatCache()
+FORMAT_STATS = stats.FormatStats()
+FORMAT_JOBS: dict[tuple, concurrent.futures.Future] = {}
+FORMAT_JOBS_LOCK = threading.Lock()
 RUNNER = pathlib.Path(__file__).parent / "runner.py"
 
 MAX_WORKERS = 5
+STATS_REQUEST = "ufmt/stats"
+FORMAT_WORKSPACE_REQUEST = "ufmt/formatWorkspace"
+
+
+class UfmtLanguageServerProtocol(protocol.LanguageServerProtocol):
+    """Language server protocol for handling requests on worker threads.
+
+    pygls can only cancel coroutine handlers, so requests for thread handlers
+    are tracked here and skipped if they were cancelled before they started.
+
+    This overrides private methods of pygls' protocol, so it depends on the
+    pygls version pinned in requirements.txt (1.3.1); check these overrides
+    whenever pygls is upgraded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_requests = set()
+        self._cancelled_requests = set()
+        self._requests_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def _send_data(self, data):
+        # Worker threads send responses and log messages too, so keep each
+        # message's bytes together on the transport.
+        with self._send_lock:
+            super()._send_data(data)
+
+    def _execute_request(self, msg_id, handler, params):
+        if not feature_manager.is_thread_function(handler):
+            super()._execute_request(msg_id, handler, params)
+            return
+
+        def _run_request():
+            with self._requests_lock:
+                self._pending_requests.discard(msg_id)
+                if msg_id in self._cancelled_requests:
+                    self._cancelled_requests.discard(msg_id)
+                    raise JsonRpcRequestCancelled(
+                        f'Request with id "{msg_id}" is canceled'
+                    )
+            return handler(params)
+
+        with self._requests_lock:
+            self._pending_requests.add(msg_id)
+        self._server.thread_pool.apply_async(
+            _run_request,
+            callback=functools.partial(self._send_response, msg_id),
+            error_callback=functools.partial(self._thread_request_err_callback, msg_id),
+        )
+
+    def _thread_request_err_callback(self, msg_id, exc):
+        if isinstance(exc, JsonRpcRequestCancelled):
+            self._send_response(msg_id, error=exc.to_response_error())
+        else:
+            self._execute_request_err_callback(msg_id, exc)
+
+    def _handle_cancel_notification(self, msg_id):
+        with self._requests_lock:
+            if msg_id in self._pending_requests:
+                self._cancelled_requests.add(msg_id)
+                return
+        super()._handle_cancel_notification(msg_id)
+
+
 LSP_SERVER = server.LanguageServer(
     name=UFMT_NAME,
     version=UFMT_VERSION,
     max_workers=MAX_WORKERS,
+    protocol_cls=UfmtLanguageServerProtocol,
+    notebook_document_sync=lsp.NotebookDocumentSyncOptions(
+        notebook_selector=[
+            lsp.NotebookDocumentSyncOptionsNotebookSelectorType2(
+                cells=[
+                    lsp.NotebookDocumentSyncOptionsNotebookSelectorType2CellsType(
+                        language="python"
+                    )
+                ]
+            )
+        ]
+    ),
 )
 
 
@@ -91,6 +196,7 @@ TOOL_ARGS = ["format"]  # default arguments always passed to your tool.
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_FORMATTING)
+@LSP_SERVER.thread()
 def formatting(params: lsp.DocumentFormattingParams) -> list[lsp.TextEdit] | None:
     """LSP handler for textDocument/formatting request."""
     # If your tool is a formatter you can use this handler to provide
@@ -98,7 +204,7 @@ def formatting(params: lsp.DocumentFormattingParams) -> list[lsp.TextEdit] | Non
     # objects, to provide your formatted results.
 
     document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
-    edits = _formatting_helper(document)
+    edits = _format_with_deadline(document)
     if edits:
         return edits
 
@@ -107,52 +213,741 @@ def formatting(params: lsp.DocumentFormattingParams) -> list[lsp.TextEdit] | Non
     return None
 
 
-def _formatting_helper(document: workspace.Document) -> list[lsp.TextEdit] | None:
-    result = _run_tool_on_document(document, use_stdin=True)
-    if result is not None and result.stdout:
-        new_source = _match_line_endings(document, result.stdout)
-        return [
-            lsp.TextEdit(
-                range=lsp.Range(
-                    start=lsp.Position(line=0, character=0),
-                    end=lsp.Position(line=len(document.lines), character=0),
-                ),
-                new_text=new_source,
-            )
-        ]
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_RANGE_FORMATTING)
+@LSP_SERVER.thread()
+def range_formatting(
+    params: lsp.DocumentRangeFormattingParams,
+) -> list[lsp.TextEdit] | None:
+    """LSP handler for textDocument/rangeFormatting request."""
+    document = LSP_SERVER.workspace.get_text_document(params.text_document.uri)
+    edits = _format_with_deadline(document, params.range)
+    if edits:
+        return edits
     return None
 
 
-def _get_line_endings(lines: list[str]) -> str:
-    """Returns line endings used in the text."""
+# Formatting for requests with a deadline runs here, so that the request can
+# return while the work carries on.
+FORMAT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix="ufmt-format"
+)
+# Documents, by uri and version, with overrunning formatting to apply later.
+LATE_FORMATS: set[tuple[str, int]] = set()
+LATE_FORMATS_LOCK = threading.Lock()
+
+
+def _format_with_deadline(
+    document: workspace.Document, selection: lsp.Range | None = None
+) -> list[lsp.TextEdit] | None:
+    """Formats the document, giving up on waiting once its deadline passes.
+
+    Formatting that overruns the deadline returns None, so that saving isn't
+    blocked, and its edits are sent with workspace/applyEdit when it finishes
+    if the document is still at the same version.
+    """
+    deadline = _get_settings_by_document(document)["formatDeadline"]
+    if deadline <= 0:
+        return _formatting_helper(document, selection)
+
+    document = _snapshot_document(document)
+    future = FORMAT_EXECUTOR.submit(_formatting_helper, document, selection)
     try:
-        if lines[0][-2:] == "\r\n":
-            return "\r\n"
-        return "\n"
-    except Exception:  # pylint: disable=broad-except
+        return future.result(timeout=deadline / 1000)
+    except concurrent.futures.TimeoutError:
+        pass
+
+    key = (document.uri, document.version)
+    with LATE_FORMATS_LOCK:
+        if key in LATE_FORMATS:
+            return None
+        LATE_FORMATS.add(key)
+    log_to_output(
+        f"formatting {document.uri} took over {deadline} ms,"
+        " its edits will be applied when done"
+    )
+    future.add_done_callback(functools.partial(_apply_late_edits, key))
+    return None
+
+
+def _apply_late_edits(key: tuple[str, int], future: concurrent.futures.Future):
+    """Applies edits from formatting that overran its deadline."""
+    with LATE_FORMATS_LOCK:
+        LATE_FORMATS.discard(key)
+    if future.cancelled() or future.exception() is not None or not future.result():
+        return
+
+    uri, version = key
+    if LSP_SERVER.workspace.get_text_document(uri).version != version:
+        log_to_output(f"discarding late formatting for version {version} of {uri}")
+        return
+    _apply_workspace_edits([(uri, version, future.result())])
+
+
+def _formatting_helper(
+    document: workspace.Document, selection: lsp.Range | None = None
+) -> list[lsp.TextEdit] | None:
+    line_range = None
+    if selection is not None:
+        start, end = selection.start.line, selection.end.line
+        # A selection ending at the start of a line doesn't include that line.
+        if selection.end.character == 0 and end > start:
+            end -= 1
+        line_range = (start, end)
+
+    # Formatting runs on worker threads, so work from a snapshot that later
+    # changes to the document can't modify mid-request.
+    document = _snapshot_document(document)
+
+    if line_range is None:
+        with PREFORMAT_LOCK:
+            preformatted = PREFORMAT_RESULTS.get(document.uri)
+        if (
+            preformatted is not None
+            and preformatted[0] == document.version
+            and preformatted[1] == _config_stamp(pathlib.Path(document.path))
+        ):
+            log_to_output("formatting result from pre-format")
+            return preformatted[2]
+
+        notebook = _get_notebook_cells(document)
+        if notebook is not None and _get_execution_mode(
+            _get_settings_by_document(document)
+        ) in ("in-process", "process-pool"):
+            return _get_notebook_cell_edits(document, *notebook)
+
+    # Requests for the same document version and range share a single run.
+    key = (document.uri, document.version, line_range)
+    with FORMAT_JOBS_LOCK:
+        job = FORMAT_JOBS.get(key)
+        is_owner = job is None
+        if is_owner:
+            job = FORMAT_JOBS[key] = concurrent.futures.Future()
+
+    if not is_owner:
+        log_to_output("waiting on pending formatting request")
+        return job.result()
+
+    try:
+        edits = _get_formatting_edits(document, line_range)
+        if _is_superseded(document):
+            edits = None
+    except BaseException as e:
+        job.set_exception(e)
+        raise
+    finally:
+        with FORMAT_JOBS_LOCK:
+            del FORMAT_JOBS[key]
+    job.set_result(edits)
+    return edits
+
+
+def _snapshot_document(document: workspace.Document) -> workspace.Document:
+    """Returns a copy of the document that later changes won't modify."""
+    return workspace.Document(
+        document.uri,
+        source=document.source,
+        version=document.version,
+        language_id=document.language_id,
+    )
+
+
+def _is_superseded(document: workspace.Document) -> bool:
+    """Returns true if the document has changed since the given snapshot."""
+    live_document = LSP_SERVER.workspace.get_text_document(document.uri)
+    if live_document.version == document.version:
+        return False
+    log_to_output(
+        f"skipping formatting for superseded version {document.version}"
+        f" of {document.uri}"
+    )
+    return True
+
+
+def _get_formatting_edits(
+    document: workspace.Document, line_range: tuple[int, int] | None
+) -> list[lsp.TextEdit] | None:
+    # A newer version of the document arrived while this request was queued;
+    # its own request will format it, so don't spend time on this one.
+    if _is_superseded(document):
         return None
 
+    settings = _get_settings_by_document(document)
+    mode = _get_execution_mode(settings)
+    with FORMAT_STATS.timer(mode, "total"):
+        result = _run_tool_on_document(document, use_stdin=True, line_range=line_range)
+        if result is None or not result.stdout:
+            return None
+
+        with FORMAT_STATS.timer(mode, "matchLineEndings"):
+            new_source = _match_line_endings(document, result.stdout)
+
+        with FORMAT_STATS.timer(mode, "textEdits"):
+            if line_range is None:
+                return _get_text_edits(
+                    document.source, new_source, settings["maxTextEdits"]
+                )
+
+            # Only keep edits touching the selection, in case the tool
+            # formatted more than the requested lines.
+            start, end = line_range
+            return [
+                edit
+                for edit in _get_text_edits(document.source, new_source, sys.maxsize)
+                if edit.range.start.line <= end
+                and max(edit.range.end.line, edit.range.start.line + 1) > start
+            ]
+
+
+def _split_lines(text: str) -> list[str]:
+    """Splits text into lines with line endings, breaking lines the same way as LSP."""
+    return io.StringIO(text, newline="").readlines()
+
+
+def _get_text_edits(source: str, new_source: str, max_edits: int) -> list[lsp.TextEdit]:
+    """Returns line-level edits that turn `source` into `new_source`.
+
+    Falls back to a single edit replacing the whole document when the change
+    needs more than `max_edits` separate edits.
+    """
+    if new_source == source:
+        return []
+    lines = _split_lines(source)
+    new_lines = _split_lines(new_source)
+    edits = []
+    matcher = difflib.SequenceMatcher(a=lines, b=new_lines)
+    for tag, start, end, new_start, new_end in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if len(edits) >= max_edits:
+            return [_get_text_edit(0, len(lines), new_source)]
+        edits.append(_get_text_edit(start, end, "".join(new_lines[new_start:new_end])))
+    return edits
+
+
+def _get_text_edit(start: int, end: int, new_text: str) -> lsp.TextEdit:
+    """Returns an edit replacing whole lines from `start` up to `end`."""
+    return lsp.TextEdit(
+        range=lsp.Range(
+            start=lsp.Position(line=start, character=0),
+            end=lsp.Position(line=end, character=0),
+        ),
+        new_text=new_text,
+    )
+
+
+def _get_line_endings(text: str) -> str | None:
+    """Returns line endings used in the text, judging by its first line.
+
+    Only the first line is looked at, like black does, so this costs the
+    length of that line rather than of the whole text.
+    """
+    end = text.find("\n")
+    if end < 0:
+        return None
+    if end > 0 and text[end - 1] == "\r":
+        return "\r\n"
+    return "\n"
+
 
 def _match_line_endings(document: workspace.Document, text: str) -> str:
     """Ensures that the edited text line endings matches the document line endings."""
-    expected = _get_line_endings(document.source.splitlines(keepends=True))
-    actual = _get_line_endings(text.splitlines(keepends=True))
+    expected = _get_line_endings(document.source)
+    actual = _get_line_endings(text)
     if actual == expected or actual is None or expected is None:
         return text
     return text.replace(actual, expected)
 
 
+def _normalize_line_endings(text: str) -> str:
+    """Returns text with CRLF line endings replaced, copying it only if needed."""
+    if "\r\n" not in text:
+        return text
+    return text.replace("\r\n", "\n")
+
+
 # **********************************************************
 # Formatting features ends here
 # **********************************************************
 
 
+# **********************************************************
+# Background pre-formatting.
+# **********************************************************
+# Seconds to wait after the last open or change before pre-formatting.
+PREFORMAT_DELAY = 0.5
+PREFORMAT_TIMERS: dict[str, threading.Timer] = {}
+# Edits by document, along with the document version and the config stamp
+# they were made for.
+PREFORMAT_RESULTS: dict[str, tuple[int, tuple, list[lsp.TextEdit] | None]] = {}
+PREFORMAT_LOCK = threading.Lock()
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
+def did_open(params: lsp.DidOpenTextDocumentParams) -> None:
+    """LSP handler for textDocument/didOpen notification."""
+    _schedule_preformat(params.text_document.uri)
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
+def did_change(params: lsp.DidChangeTextDocumentParams) -> None:
+    """LSP handler for textDocument/didChange notification."""
+    _schedule_preformat(params.text_document.uri)
+
+
+@LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CLOSE)
+def did_close(params: lsp.DidCloseTextDocumentParams) -> None:
+    """LSP handler for textDocument/didClose notification."""
+    _cancel_preformat(params.text_document.uri)
+
+
+def _schedule_preformat(uri: str) -> None:
+    """Formats the document in the background once edits pause, if enabled.
+
+    The edits are kept against the document version, so that a formatting
+    request for that version, such as on save, can return them right away.
+    """
+    document = LSP_SERVER.workspace.get_text_document(uri)
+    settings = _get_settings_by_document(document)
+    _cancel_preformat(uri)
+    if not settings["preformat"]:
+        return
+
+    timer = threading.Timer(PREFORMAT_DELAY, _preformat, args=(uri,))
+    timer.daemon = True
+    with PREFORMAT_LOCK:
+        PREFORMAT_TIMERS[uri] = timer
+    timer.start()
+
+
+def _cancel_preformat(uri: str) -> None:
+    """Cancels pending pre-formatting and drops stored edits for the document."""
+    with PREFORMAT_LOCK:
+        timer = PREFORMAT_TIMERS.pop(uri, None)
+        PREFORMAT_RESULTS.pop(uri, None)
+    if timer is not None:
+        timer.cancel()
+
+
+def _preformat(uri: str) -> None:
+    with PREFORMAT_LOCK:
+        if PREFORMAT_TIMERS.get(uri) is not threading.current_thread():
+            return
+        del PREFORMAT_TIMERS[uri]
+
+    document = LSP_SERVER.workspace.text_documents.get(uri)
+    if document is None or document.version is None:
+        return
+    version = document.version
+    try:
+        stamp = _config_stamp(pathlib.Path(document.path))
+        edits = _formatting_helper(document)
+    except Exception:  # pylint: disable=broad-except
+        log_to_output("pre-format failed:\n" + traceback.format_exc())
+        return
+
+    with PREFORMAT_LOCK:
+        live_document = LSP_SERVER.workspace.text_documents.get(uri)
+        if live_document is not None and live_document.version == version:
+            PREFORMAT_RESULTS[uri] = (version, stamp, edits)
+            log_to_output(f"pre-formatted version {version} of {uri}")
+
+
+# **********************************************************
+# Notebook formatting.
+# **********************************************************
+# Edits for each code cell by notebook, along with the cell version and the
+# config fingerprint they were made for.
+NOTEBOOK_RESULTS: dict[str, dict[str, tuple[int, str, list[lsp.TextEdit] | None]]] = {}
+NOTEBOOK_LOCKS: dict[str, threading.Lock] = {}
+NOTEBOOK_LOCK = threading.Lock()
+
+
+@LSP_SERVER.feature(lsp.NOTEBOOK_DOCUMENT_DID_CLOSE)
+def did_close_notebook(params: lsp.DidCloseNotebookDocumentParams) -> None:
+    """LSP handler for notebookDocument/didClose notification."""
+    with NOTEBOOK_LOCK:
+        NOTEBOOK_RESULTS.pop(params.notebook_document.uri, None)
+        NOTEBOOK_LOCKS.pop(params.notebook_document.uri, None)
+
+
+def _get_notebook_cells(
+    document: workspace.Document,
+) -> tuple[str, list[str]] | None:
+    """Returns the notebook uri and the uris of its code cells, if the document is a cell."""
+    notebook = LSP_SERVER.workspace.get_notebook_document(cell_uri=document.uri)
+    if notebook is not None:
+        return notebook.uri, [
+            cell.document
+            for cell in notebook.cells
+            if cell.kind == lsp.NotebookCellKind.Code
+        ]
+
+    if not str(document.uri).startswith("vscode-notebook-cell"):
+        return None
+
+    # Clients without notebook sync open each cell as a text document. Cells
+    # of a notebook share its uri, and differ only in the fragment.
+    notebook_uri = document.uri.partition("#")[0]
+    prefix = f"{notebook_uri}#"
+    return notebook_uri, [
+        uri
+        for uri in list(LSP_SERVER.workspace.text_documents)
+        if uri.startswith(prefix)
+    ]
+
+
+def _get_notebook_cell_edits(
+    document: workspace.Document, notebook_uri: str, cell_uris: list[str]
+) -> list[lsp.TextEdit] | None:
+    """Returns edits for a notebook cell, formatting the notebook's cells as a batch.
+
+    Every cell changed since the last batch is formatted with a single config
+    and tool environment, and the edits for the other cells are kept for their
+    own formatting requests, as when formatting a whole notebook.
+    """
+    with NOTEBOOK_LOCK:
+        lock = NOTEBOOK_LOCKS.setdefault(notebook_uri, threading.Lock())
+
+    with lock:
+        cells = [
+            _snapshot_document(LSP_SERVER.workspace.get_text_document(uri))
+            for uri in cell_uris
+        ]
+        cells = [cell for cell in cells if cell.language_id in (None, "python")]
+        with NOTEBOOK_LOCK:
+            results = NOTEBOOK_RESULTS.setdefault(notebook_uri, {})
+        for uri in results.keys() - {cell.uri for cell in cells}:
+            del results[uri]
+        _format_notebook_cells(cells, results)
+        version, _, edits = results.get(document.uri, (None, None, None))
+
+    if version != document.version:
+        return None
+    return edits
+
+
+def _format_notebook_cells(
+    cells: list[workspace.Document],
+    results: dict[str, tuple[int, str, list[lsp.TextEdit] | None]],
+) -> None:
+    """Formats the cells whose results are missing or out of date."""
+    if not cells:
+        return
+
+    settings = _get_settings_by_document(cells[0])
+    mode = _get_execution_mode(settings)
+    _wait_for_warm_up()
+    tools = _get_tool_environment()
+    if tools is None:
+        return
+
+    notebook_path = pathlib.Path(cells[0].path).resolve()
+    with FORMAT_STATS.timer(mode, "resolveConfig"):
+        config = _get_format_config(tools, notebook_path, mode)
+
+    stale = [
+        cell
+        for cell in cells
+        if results.get(cell.uri, (None, None))[:2] != (cell.version, config.fingerprint)
+    ]
+    if not stale:
+        log_to_output("formatting result from notebook batch")
+        return
+
+    log_to_output(f"formatting {len(stale)} of {len(cells)} notebook cells")
+    with FORMAT_STATS.timer(mode, "notebook"):
+        for cell in stale:
+            edits = None
+            try:
+                new_source = _format_document(
+                    tools,
+                    config,
+                    notebook_path,
+                    cell.source.encode("utf-8"),
+                    use_process_pool=mode == "process-pool",
+                    auto_engine=settings["engine"] == "auto",
+                ).decode("utf-8")
+                # Unlike files, cells don't end with a newline.
+                if new_source.endswith("\n") and not cell.source.endswith("\n"):
+                    new_source = new_source.rstrip("\r\n")
+                edits = _get_text_edits(
+                    cell.source,
+                    _match_line_endings(cell, new_source),
+                    settings["maxTextEdits"],
+                )
+            except (tools.libcst.ParserSyntaxError, SyntaxError) as e:
+                log_warning(f"Failed to format {cell.uri}: {e}")
+            except UfmtError as e:
+                log_error(str(e))
+            except worker.WorkerError as e:
+                log_error(f"uncaught exception:\n{e}")
+            except Exception:  # pylint: disable=broad-except
+                log_error("uncaught exception:\n" + traceback.format_exc(chain=True))
+            results[cell.uri] = (cell.version, config.fingerprint, edits)
+
+
+# **********************************************************
+# Workspace formatting.
+# **********************************************************
+# Number of formatted documents sent to the client in each workspace/applyEdit.
+FORMAT_WORKSPACE_BATCH_SIZE = 20
+# Number of documents sent to a runner in each runBatch request.
+RPC_BATCH_SIZE = 20
+
+
+@LSP_SERVER.feature(FORMAT_WORKSPACE_REQUEST)
+@LSP_SERVER.thread()
+def format_workspace(params) -> dict:
+    """Handler for the ufmt/formatWorkspace custom request.
+
+    Formats every Python file in the workspace folder given by the `workspace`
+    URI param, or in every workspace folder if not given, skipping paths
+    excluded by ufmt config or gitignore. Edits are sent to the client in
+    batches with workspace/applyEdit, and progress is reported with
+    $/progress if the client supports it.
+    """
+    workspace_uri = getattr(params, "workspace", None) if params else None
+    roots = [
+        settings["workspaceFS"]
+        for settings in WORKSPACE_SETTINGS.values()
+        if workspace_uri is None
+        or utils.is_same_path(settings["workspaceFS"], uris.to_fs_path(workspace_uri))
+    ]
+    summary = {"files": 0, "changed": 0, "failed": 0}
+
+    tools = _get_tool_environment()
+    if tools is None or not roots:
+        return summary
+
+    token = _begin_progress(
+        getattr(params, "workDoneToken", None) if params else None,
+        "Formatting workspace",
+    )
+    try:
+        batch = []
+        for uri, version, edits in _format_workspace_files(
+            tools, roots, lambda: _is_progress_cancelled(token)
+        ):
+            summary["files"] += 1
+            if edits is None:
+                summary["failed"] += 1
+                continue
+            if not edits:
+                continue
+            summary["changed"] += 1
+            batch.append((uri, version, edits))
+            if len(batch) >= FORMAT_WORKSPACE_BATCH_SIZE:
+                _apply_workspace_edits(batch)
+                batch = []
+            _report_progress(token, f"{summary['files']} files formatted")
+        if batch:
+            _apply_workspace_edits(batch)
+    finally:
+        _end_progress(
+            token, f"{summary['changed']} of {summary['files']} files changed"
+        )
+
+    return summary
+
+
+def _format_workspace_files(tools: ToolEnvironment, roots: list[str], is_cancelled):
+    """Formats files under the roots in parallel, yielding them as they finish.
+
+    Yields the document uri, the version that was formatted, and its edits,
+    which are empty if unchanged and None if formatting failed. Only a few
+    files per worker are in flight at a time, so memory stays bounded no
+    matter how large the workspace is. Files of workspaces using another
+    interpreter are sent to its runners in batches.
+    """
+    max_pending = PROCESS_POOL_SIZE * 2
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=PROCESS_POOL_SIZE, thread_name_prefix="ufmt-workspace"
+    ) as executor:
+        pending = set()
+        batches: dict[str, list[pathlib.Path]] = {}
+        for path in _walk_workspace_files(tools, roots):
+            if is_cancelled():
+                log_to_output("workspace formatting cancelled")
+                break
+            settings = _get_settings_by_path(os.fspath(path))
+            if _get_execution_mode(settings) == "rpc":
+                batch = batches.setdefault(settings["workspaceFS"], [])
+                batch.append(path)
+                if len(batch) < RPC_BATCH_SIZE:
+                    continue
+                del batches[settings["workspaceFS"]]
+                paths = batch
+            else:
+                paths = [path]
+            pending.add(executor.submit(_format_workspace_paths, paths))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield from future.result()
+        if not is_cancelled():
+            for batch in batches.values():
+                pending.add(executor.submit(_format_workspace_paths, batch))
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def _walk_workspace_files(tools: ToolEnvironment, roots: list[str]):
+    """Yields Python files under the roots, honoring ufmt excludes and gitignore."""
+    runner = tools.trailrunner.Trailrunner()
+    for root in roots:
+        root_path = pathlib.Path(root).resolve()
+        with _bundled_sys_path():
+            ufmt_config = tools.ufmt.config.load_config(root_path / "_.py")
+        yield from runner.walk(root_path, excludes=ufmt_config.excludes)
+
+
+def _format_workspace_paths(paths: list[pathlib.Path]) -> list:
+    if len(paths) > 1:
+        return _format_workspace_batch(paths)
+    return [_format_workspace_file(path) for path in paths]
+
+
+def _read_workspace_document(path: pathlib.Path) -> workspace.Document:
+    """Returns the open document for the path, or reads it from disk."""
+    uri = uris.from_fs_path(os.fspath(path))
+    document = LSP_SERVER.workspace.text_documents.get(uri)
+    if document is None:
+        with open(path, encoding="utf-8", newline="") as f:
+            return workspace.Document(uri, source=f.read())
+    return workspace.Document(uri, source=document.source, version=document.version)
+
+
+def _format_workspace_file(path: pathlib.Path):
+    uri = uris.from_fs_path(os.fspath(path))
+    try:
+        document = _read_workspace_document(path)
+        result = _run_tool_on_document(document, use_stdin=True)
+        return _get_workspace_file_edits(document, result)
+    except Exception:  # pylint: disable=broad-except
+        log_error(f"failed to format {path}:\n" + traceback.format_exc())
+        return uri, None, None
+
+
+def _format_workspace_batch(paths: list[pathlib.Path]) -> list:
+    """Formats files of one workspace with a single request to its runners.
+
+    The runner streams results back as it goes, so edits are computed for
+    each file while the rest of the batch is still being formatted.
+    """
+    results = []
+    documents = []
+    for path in paths:
+        try:
+            documents.append(_read_workspace_document(path))
+        except Exception:  # pylint: disable=broad-except
+            log_error(f"failed to format {path}:\n" + traceback.format_exc())
+            results.append((uris.from_fs_path(os.fspath(path)), None, None))
+    if not documents:
+        return results
+
+    settings = _get_settings_by_document(documents[0])
+    log_to_output(f"formatting {len(documents)} files via rpc")
+    with FORMAT_STATS.timer("rpc", "rpcBatch"):
+        for index, rpc_result in jsonrpc.run_batch_over_json_rpc(
+            interpreter=settings["interpreter"],
+            module=TOOL_MODULE,
+            cwd=settings["workspaceFS"],
+            documents=[(document.path, document.source) for document in documents],
+        ):
+            document = documents[index]
+            if rpc_result.exception:
+                log_error(f"failed to format {document.path}:\n{rpc_result.exception}")
+            elif rpc_result.stderr:
+                log_to_output(rpc_result.stderr)
+            try:
+                results.append(
+                    _get_workspace_file_edits(
+                        document, utils.RunResult(rpc_result.stdout, rpc_result.stderr)
+                    )
+                )
+            except Exception:  # pylint: disable=broad-except
+                log_error(
+                    f"failed to format {document.path}:\n" + traceback.format_exc()
+                )
+                results.append((document.uri, None, None))
+    return results
+
+
+def _get_workspace_file_edits(
+    document: workspace.Document, result: utils.RunResult | None
+):
+    """Returns the uri, version, and edits for a formatted workspace file."""
+    if result is None or not result.stdout:
+        return document.uri, document.version, None
+    new_source = _match_line_endings(document, result.stdout)
+    settings = _get_settings_by_document(document)
+    edits = _get_text_edits(document.source, new_source, settings["maxTextEdits"])
+    return document.uri, document.version, edits
+
+
+def _apply_workspace_edits(batch) -> None:
+    """Sends formatting edits for several documents in one workspace/applyEdit."""
+    capabilities = LSP_SERVER.client_capabilities.workspace
+    workspace_edit = capabilities and capabilities.workspace_edit
+    if workspace_edit and workspace_edit.document_changes:
+        edit = lsp.WorkspaceEdit(
+            document_changes=[
+                lsp.TextDocumentEdit(
+                    text_document=lsp.OptionalVersionedTextDocumentIdentifier(
+                        uri=uri, version=version
+                    ),
+                    edits=edits,
+                )
+                for uri, version, edits in batch
+            ]
+        )
+    else:
+        edit = lsp.WorkspaceEdit(changes={uri: edits for uri, _, edits in batch})
+
+    response = LSP_SERVER.apply_edit(edit, f"Format with {TOOL_DISPLAY}").result()
+    if response is not None and not response.applied:
+        log_warning(f"client did not apply edits: {response.failure_reason}")
+
+
+def _begin_progress(token, title: str):
+    """Starts reporting progress, returning the token or None if unsupported."""
+    if token is None:
+        capabilities = LSP_SERVER.client_capabilities.window
+        if not (capabilities and capabilities.work_done_progress):
+            return None
+        token = f"{UFMT_NAME}-{uuid.uuid4()}"
+        LSP_SERVER.progress.create(token).result()
+    LSP_SERVER.progress.begin(
+        token, lsp.WorkDoneProgressBegin(title=title, cancellable=True)
+    )
+    return token
+
+
+def _report_progress(token, message: str) -> None:
+    if token is not None:
+        LSP_SERVER.progress.report(token, lsp.WorkDoneProgressReport(message=message))
+
+
+def _end_progress(token, message: str) -> None:
+    if token is not None:
+        LSP_SERVER.progress.end(token, lsp.WorkDoneProgressEnd(message=message))
+        LSP_SERVER.progress.tokens.pop(token, None)
+
+
+def _is_progress_cancelled(token) -> bool:
+    future = LSP_SERVER.progress.tokens.get(token)
+    return future is not None and future.cancelled()
+
+
 # **********************************************************
 # Required Language Server Initialization and Exit handlers.
 # **********************************************************
 @LSP_SERVER.feature(lsp.INITIALIZE)
 def initialize(params: lsp.InitializeParams) -> None:
     """LSP handler for initialize request."""
+    global PROCESS_POOL_SIZE  # pylint: disable=global-statement
     log_to_output(f"CWD Server: {os.getcwd()}")
 
     paths = "\r\n   ".join(sys.path)
@@ -160,60 +955,313 @@ def initialize(params: lsp.InitializeParams) -> None:
 
     settings = params.initialization_options["settings"]
     _update_workspace_settings(settings)
+    default_settings = _get_settings_by_document(None)
+    _set_format_cache_size(default_settings["formatCacheSize"])
+    _configure_disk_cache(default_settings["diskCacheSize"])
+    _configure_runners(default_settings)
+    PROCESS_POOL_SIZE = _get_process_pool_size(default_settings["processPoolSize"])
+    _start_warm_up()
+    _start_runners()
     log_to_output(
         f"Settings used to run Server:\r\n{json.dumps(settings, indent=4, ensure_ascii=False)}\r\n"
     )
 
 
-@LSP_SERVER.feature(lsp.EXIT)
-def on_exit():
-    """Handle clean up on exit."""
+@LSP_SERVER.feature(lsp.INITIALIZED)
+def initialized(params: lsp.InitializedParams) -> None:
+    """LSP handler for initialized notification."""
+    global WATCHING_CONFIG_FILES  # pylint: disable=global-statement
+    capabilities = LSP_SERVER.client_capabilities.workspace
+    watched_files = capabilities and capabilities.did_change_watched_files
+    if watched_files and watched_files.dynamic_registration:
+        WATCHING_CONFIG_FILES = True
+        LSP_SERVER.register_capability(
+            lsp.RegistrationParams(
+                registrations=[
+                    lsp.Registration(
+                        id=f"{UFMT_NAME}-config-files",
+                        method=lsp.WORKSPACE_DID_CHANGE_WATCHED_FILES,
+                        register_options=lsp.DidChangeWatchedFilesRegistrationOptions(
+                            watchers=[
+                                lsp.FileSystemWatcher(glob_pattern=f"**/{name}")
+                                for name in CONFIG_FILE_NAMES
+                            ]
+                        ),
+                    )
+                ]
+            )
+        )
+
+
+@LSP_SERVER.feature(lsp.WORKSPACE_DID_CHANGE_WATCHED_FILES)
+def did_change_watched_files(params: lsp.DidChangeWatchedFilesParams) -> None:
+    """LSP handler for workspace/didChangeWatchedFiles notification."""
+    for change in params.changes:
+        path = uris.to_fs_path(change.uri)
+        if path and os.path.basename(path) in CONFIG_FILE_NAMES:
+            log_to_output(f"config file changed: {path}")
+            _invalidate_config_cache(path)
+
+
+@LSP_SERVER.feature(lsp.WORKSPACE_DID_CHANGE_CONFIGURATION)
+def did_change_configuration(params: lsp.DidChangeConfigurationParams) -> None:
+    """LSP handler for workspace/didChangeConfiguration notification.
+
+    The client sends the same per-workspace settings as in initializationOptions.
+    Settings are applied in place, and only the caches and processes that
+    depend on a changed setting are dropped.
+    """
+    settings = params.settings
+    if isinstance(settings, dict):
+        settings = settings.get("settings")
+    if not isinstance(settings, list) or not settings:
+        return
+
+    changed = _update_workspace_settings(settings)
+    log_to_output(f"settings changed: {', '.join(sorted(changed)) or 'none'}")
+    _apply_settings_changes(changed)
+
+
+@LSP_SERVER.feature(lsp.SHUTDOWN)
+def on_shutdown(*_args):
+    """Handle clean up on shutdown."""
+    # pygls exits the process before calling user handlers for `exit`, so
+    # worker and runner processes have to be stopped here.
+    FORMAT_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    _shutdown_process_pool()
     jsonrpc.shutdown_json_rpc()
+    _close_disk_cache()
+
+
+@LSP_SERVER.feature(STATS_REQUEST)
+def stats_request(*_args) -> dict:
+    """Handler for the ufmt/stats custom request.
+
+    Returns latency percentiles, in milliseconds, for each phase of formatting
+    by execution mode, along with hit rates for the format and config caches
+    and the runner processes started for each interpreter.
+    """
+    format_hits, format_misses = FORMAT_CACHE.hits, FORMAT_CACHE.misses
+    caches = {
+        "format": _cache_stats(format_hits, format_misses),
+        **{
+            name: _cache_stats(*FORMAT_STATS.cache_counts(name))
+            for name in ("config", "sort", "formatter")
+        },
+    }
+    disk_cache = DISK_CACHE
+    if disk_cache is not None:
+        caches["disk"] = _cache_stats(disk_cache.hits, disk_cache.misses)
+    return {
+        "latency": FORMAT_STATS.latencies(),
+        "caches": caches,
+        "runners": jsonrpc.runner_counts(),
+    }
+
+
+def _cache_stats(hits: int, misses: int) -> dict:
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hitRate": hits / lookups if lookups else 0.0,
+    }
 
 
 # *****************************************************
 # Internal functional and settings management APIs.
 # *****************************************************
-def _update_workspace_settings(settings):
-    for setting in settings:
-        key = uris.to_fs_path(setting["workspace"])
-        WORKSPACE_SETTINGS[key] = {
-            **setting,
-            "workspaceFS": key,
+def _update_workspace_settings(settings) -> set[str]:
+    """Stores settings for each workspace, returning the names of changed settings."""
+    changed: set[str] = set()
+    old_interpreters: set[tuple[str, ...]] = set()
+    with SETTINGS_LOCK:
+        for setting in settings:
+            key = uris.to_fs_path(setting["workspace"])
+            new_settings = _freeze_settings(
+                {
+                    **setting,
+                    "workspaceFS": key,
+                }
+            )
+            old_settings = WORKSPACE_SETTINGS.get(key, {})
+            workspace_changed = {
+                name
+                for name in new_settings.keys() | old_settings.keys()
+                if new_settings.get(name) != old_settings.get(name)
+            }
+            if old_settings and "interpreter" in workspace_changed:
+                old_interpreters.add(tuple(old_settings["interpreter"]))
+            changed |= workspace_changed
+            WORKSPACE_SETTINGS[key] = new_settings
+        SETTINGS_BY_DIRECTORY.clear()
+        old_interpreters -= {
+            tuple(settings["interpreter"]) for settings in WORKSPACE_SETTINGS.values()
         }
 
+    # Runners are shared by interpreter, so only stop those nobody uses anymore.
+    for interpreter in old_interpreters:
+        jsonrpc.stop_runners(interpreter)
+    return changed
 
-def _get_settings_by_document(document: workspace.Document | None):
-    if len(WORKSPACE_SETTINGS) == 1 or document is None or document.path is None:
-        return list(WORKSPACE_SETTINGS.values())[0]
 
-    document_workspace = pathlib.Path(document.path)
-    workspaces = {s["workspaceFS"] for s in WORKSPACE_SETTINGS.values()}
+# Settings that only affect the client or logging, and never formatting results.
+DISPLAY_SETTINGS = frozenset(("logLevel", "showNotifications"))
+RUNNER_SETTINGS = frozenset(
+    ("minRunners", "maxRunners", "maxRunnerRequests", "maxRunnerMemory")
+)
+
+
+def _apply_settings_changes(changed: set[str]) -> None:
+    """Resizes or drops whatever depends on changed settings."""
+    global PROCESS_POOL_SIZE  # pylint: disable=global-statement
+    default_settings = _get_settings_by_document(None)
+
+    if "formatCacheSize" in changed:
+        _set_format_cache_size(default_settings["formatCacheSize"])
+
+    if "diskCacheSize" in changed:
+        _configure_disk_cache(default_settings["diskCacheSize"])
+
+    if changed & RUNNER_SETTINGS:
+        _configure_runners(default_settings)
+
+    if changed & {"interpreter", "path", "minRunners", "maxRunners"}:
+        _start_runners()
+
+    if "processPoolSize" in changed or "executionMode" in changed:
+        size = _get_process_pool_size(default_settings["processPoolSize"])
+        in_use = any(
+            _get_execution_mode(settings) == "process-pool"
+            for settings in WORKSPACE_SETTINGS.values()
+        )
+        if size != PROCESS_POOL_SIZE or not in_use:
+            _shutdown_process_pool()
+        PROCESS_POOL_SIZE = size
+        if in_use:
+            _start_warm_up()
+
+    if "engine" in changed and BLACK_SPEED is None:
+        # The warm-up calibrates black if any workspace now uses "auto".
+        _start_warm_up()
+
+    if changed - DISPLAY_SETTINGS:
+        with PREFORMAT_LOCK:
+            PREFORMAT_RESULTS.clear()
+        with NOTEBOOK_LOCK:
+            NOTEBOOK_RESULTS.clear()
+
+
+def _configure_runners(settings) -> None:
+    jsonrpc.configure_runners(
+        settings["minRunners"],
+        settings["maxRunners"],
+        settings["maxRunnerRequests"],
+        settings["maxRunnerMemory"] * 1024 * 1024,
+    )
+
 
-    # COMMENT: about non workspace files
-    while document_workspace != document_workspace.parent:
-        if str(document_workspace) in workspaces:
-            break
-        document_workspace = document_workspace.parent
+def _freeze_settings(settings: dict) -> types.MappingProxyType:
+    """Returns a read-only view of settings, with lists turned into tuples.
 
-    return WORKSPACE_SETTINGS[str(document_workspace)]
+    Settings are shared by every request, so they are never copied or changed
+    after they are received from the client.
+    """
+    return types.MappingProxyType(
+        {
+            key: tuple(value) if isinstance(value, list) else value
+            for key, value in settings.items()
+        }
+    )
+
+
+def _get_settings_by_document(document: workspace.Document | None):
+    if document is None or document.path is None:
+        return next(iter(WORKSPACE_SETTINGS.values()))
+    return _get_settings_by_path(document.path)
+
+
+def _get_settings_by_path(path: str):
+    if len(WORKSPACE_SETTINGS) == 1:
+        return next(iter(WORKSPACE_SETTINGS.values()))
+
+    directory = os.path.dirname(path)
+    settings = SETTINGS_BY_DIRECTORY.get(directory)
+    if settings is None:
+        # Look up and store under the lock, so settings found just before an
+        # update can't be stored after the update clears the memo.
+        with SETTINGS_LOCK:
+            settings = SETTINGS_BY_DIRECTORY.get(directory)
+            if settings is None:
+                settings = _find_workspace_settings(directory)
+                SETTINGS_BY_DIRECTORY[directory] = settings
+    return settings
+
+
+def _find_workspace_settings(directory: str):
+    """Returns settings for the innermost workspace folder containing a directory.
+
+    Workspace settings are indexed by folder path, so this is a longest prefix
+    match costing one lookup per parent directory. Files outside of every
+    workspace folder use the settings of the first folder.
+    """
+    while True:
+        settings = WORKSPACE_SETTINGS.get(directory)
+        if settings is not None:
+            return settings
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return next(iter(WORKSPACE_SETTINGS.values()))
+        directory = parent
 
 
 # *****************************************************
 # Internal execution APIs.
 # *****************************************************
+def _get_execution_mode(settings) -> str:
+    """Returns how documents in a workspace are formatted.
+
+    One of "path" (running an executable), "rpc" (a runner under a different
+    interpreter), "in-process", or "process-pool" (worker processes running
+    the same interpreter).
+    """
+    if IMPORT_STRATEGY == "useBundled":
+        return _get_in_process_mode(settings)
+    if settings["path"]:
+        # 'path' setting takes priority over everything.
+        return "path"
+    if settings["interpreter"] and not utils.is_current_interpreter(
+        settings["interpreter"][0]
+    ):
+        # If there is a different interpreter set use JSON-RPC to the subprocess
+        # running under that interpreter.
+        return "rpc"
+    # if the interpreter is same as the interpreter running this
+    # process then run as module.
+    return _get_in_process_mode(settings)
+
+
+def _get_in_process_mode(settings) -> str:
+    """Returns the mode for formatting with the interpreter running this server."""
+    if settings["executionMode"] == "processPool":
+        return "process-pool"
+    return "in-process"
+
+
 def _run_tool_on_document(
     document: workspace.Document,
     use_stdin: bool = False,
+    line_range: tuple[int, int] | None = None,
 ) -> utils.RunResult | None:
     """Runs tool on the given document.
 
     if use_stdin is true then contents of the document is passed to the
     tool via stdin.
-    """
-    if str(document.uri).startswith("vscode-notebook-cell"):
-        pass  # return None
 
+    if line_range is given, formatting is limited to that zero-based, inclusive
+    range of lines where the tools support it; otherwise the whole document is
+    formatted.
+    """
     if utils.is_stdlib_file(document.path):
         return None
 
@@ -221,33 +1269,20 @@ def _run_tool_on_document(
         log_error("vscode-ufmt requires environment with Python 3.9 or newer")
         return None
 
-    # deep copy here to prevent accidentally updating global settings.
-    settings = copy.deepcopy(_get_settings_by_document(document))
+    settings = _get_settings_by_document(document)
 
     code_workspace = settings["workspaceFS"]
     cwd = settings["workspaceFS"]
 
-    use_path = False
-    use_rpc = False
-    if IMPORT_STRATEGY == "useBundled":
+    mode = _get_execution_mode(settings)
+    if mode == "path":
+        argv = [*settings["path"]]
+    elif IMPORT_STRATEGY == "useBundled":
         argv = []
-    elif settings["path"]:
-        # 'path' setting takes priority over everything.
-        use_path = True
-        argv = settings["path"]
-    elif settings["interpreter"] and not utils.is_current_interpreter(
-        settings["interpreter"][0]
-    ):
-        # If there is a different interpreter set use JSON-RPC to the subprocess
-        # running under that interpreter.
-        argv = [TOOL_MODULE]
-        use_rpc = True
     else:
-        # if the interpreter is same as the interpreter running this
-        # process then run as module.
         argv = [TOOL_MODULE]
 
-    argv += TOOL_ARGS + settings["args"]
+    argv += [*TOOL_ARGS, *settings["args"]]
 
     if use_stdin:
         argv += ["-", document.path]
@@ -256,34 +1291,36 @@ def _run_tool_on_document(
 
     result = utils.RunResult("", "")
 
-    if use_path:
+    if mode == "path":
         # This mode is used when running executables.
         log_to_output("formatting via path")
         log_to_output(" ".join(argv))
         log_to_output(f"CWD Server: {cwd}")
-        result = utils.run_path(
-            argv=argv,
-            use_stdin=use_stdin,
-            cwd=cwd,
-            source=document.source.replace("\r\n", "\n"),
-        )
+        with FORMAT_STATS.timer(mode, "spawn"):
+            result = utils.run_path(
+                argv=argv,
+                use_stdin=use_stdin,
+                cwd=cwd,
+                source=_normalize_line_endings(document.source),
+            )
         if result.stderr:
             log_to_output(result.stderr)
-    elif use_rpc:
+    elif mode == "rpc":
         # This mode is used if the interpreter running this server is different from
         # the interpreter used for running this server.
         log_to_output("formatting via rpc")
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
+        log_to_output(" ".join([*settings["interpreter"], "-m", *argv]))
         log_to_output(f"CWD Linter: {cwd}")
 
-        result = jsonrpc.run_over_json_rpc(
-            workspace=code_workspace,
-            interpreter=settings["interpreter"],
-            module=TOOL_MODULE,
-            cwd=cwd,
-            document_path=document.path,
-            source=document.source,
-        )
+        with FORMAT_STATS.timer(mode, "rpc"):
+            result = jsonrpc.run_over_json_rpc(
+                workspace=code_workspace,
+                interpreter=settings["interpreter"],
+                module=TOOL_MODULE,
+                cwd=cwd,
+                document_path=document.path,
+                source=document.source,
+            )
         if result.exception:
             log_error(result.exception)
             result = utils.RunResult(result.stdout, result.stderr)
@@ -291,79 +1328,932 @@ def _run_tool_on_document(
             log_to_output(result.stderr)
     else:
         # In this mode the tool is run as a module in the same process as the language server.
-        log_to_output("formatting in-process")
+        log_to_output(
+            "formatting in process pool"
+            if mode == "process-pool"
+            else "formatting in-process"
+        )
         log_to_output(f"CWD Linter: {cwd}")
-        # This is needed to preserve sys.path, in cases where the tool modifies
-        # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
-            with update_sys_path(BUNDLED_LIBS, IMPORT_STRATEGY):
-                try:
-                    import ufmt
-
-                    if ufmt.__version__.startswith("1."):
-                        log_error(
-                            "ufmt >= 2.0 required, upgrade environment "
-                            'or set import strategy to "useBundled"'
-                        )
-                        return None
-
-                    import black
-                    import libcst
-                    import ufmt.util
-                    import usort
-
-                    try:
-                        import ruff_api
-
-                        ruff_api_version = ruff_api.__version__
-                    except ImportError as e:
-                        log_to_output(f"ruff-api failed to import: {e}")
-                        ruff_api_version = "None"
-
-                    log_to_output(
-                        "active versions:"
-                        f"  ufmt=={ufmt.__version__}"
-                        f"  black=={black.__version__}"
-                        f"  libcst=={libcst.LIBCST_VERSION}"
-                        f"  ruff-api=={ruff_api_version}"
-                        f"  usort=={usort.__version__}"
-                    )
-
-                    document_path = pathlib.Path(document.path).resolve()
-                    source_bytes = document.source.encode("utf-8")
+        _wait_for_warm_up()
+        tools = _get_tool_environment()
+        if tools is None:
+            return None
+        # The tools, and anything they import lazily, were loaded with the
+        # bundled libraries on sys.path by `_get_tool_environment()` and the
+        # warm-up, so requests don't touch sys.path; swapping it from several
+        # worker threads at once would corrupt it.
+        try:
+            document_path = pathlib.Path(document.path).resolve()
+            source_bytes = document.source.encode("utf-8")
+
+            with FORMAT_STATS.timer(mode, "resolveConfig"):
+                config = _get_format_config(tools, document_path, mode)
+            log_to_output(
+                "formatting with:"
+                f"  formatter={config.ufmt_config.formatter.name}"
+                f"  sorter={config.ufmt_config.sorter.name}"
+            )
 
-                    ufmt.config.load_config.cache_clear()
-                    ufmt_config = ufmt.config.load_config(document_path)
-                    log_to_output(
-                        "formatting with:"
-                        f"  formatter={ufmt_config.formatter.name}"
-                        f"  sorter={ufmt_config.sorter.name}"
+            with FORMAT_STATS.timer(mode, "format"):
+                ufmt_result = None
+                if line_range is not None:
+                    ufmt_result = _format_lines(
+                        tools,
+                        config,
+                        document_path,
+                        document.source,
+                        line_range,
                     )
 
-                    black_config = ufmt.util.make_black_config(document_path)
-                    usort_config = ufmt.types.UsortConfig.find(document_path)
-                    ufmt_result = ufmt.ufmt_bytes(
+                if ufmt_result is None:
+                    ufmt_result = _format_document(
+                        tools,
+                        config,
                         document_path,
                         source_bytes,
-                        encoding="utf-8",
-                        ufmt_config=ufmt_config,
-                        black_config=black_config,
-                        usort_config=usort_config,
-                    )
-                    result = utils.RunResult(ufmt_result.decode("utf-8"), "")
-                except (libcst.ParserSyntaxError, SyntaxError) as e:
-                    log_warning("Failed to format: " + str(e))
-                except UfmtError as e:
-                    log_error(str(e))
-                except Exception:
-                    log_error(
-                        "uncaught exception:\n" + traceback.format_exc(chain=True)
+                        use_process_pool=mode == "process-pool",
+                        auto_engine=settings["engine"] == "auto",
                     )
+            # Unchanged output needs no decoding, and handing back the source
+            # itself makes the unchanged check before diffing an identity test.
+            if ufmt_result == source_bytes:
+                result = utils.RunResult(document.source, "")
+            else:
+                result = utils.RunResult(ufmt_result.decode("utf-8"), "")
+        except (tools.libcst.ParserSyntaxError, SyntaxError) as e:
+            log_warning("Failed to format: " + str(e))
+        except UfmtError as e:
+            log_error(str(e))
+        except worker.WorkerError as e:
+            log_error(f"uncaught exception:\n{e}")
+        except Exception:
+            log_error("uncaught exception:\n" + traceback.format_exc(chain=True))
 
     log_to_output("formatting complete")
     return result
 
 
+def _format_document(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    source: bytes,
+    use_process_pool: bool = False,
+    auto_engine: bool = False,
+) -> bytes:
+    """Formats the whole document, reusing cached results for unchanged content.
+
+    If use_process_pool is true, formatting runs on a worker process instead
+    of the calling thread. If auto_engine is true, large documents may be
+    formatted with ruff-api instead of black.
+    """
+    cache_key = _format_cache_key(
+        source,
+        document_path.suffix,
+        config.fingerprint,
+        tools.versions,
+        "auto" if auto_engine else "",
+    )
+    result = FORMAT_CACHE.get(cache_key)
+    if result is not None:
+        log_to_output("formatting result from cache")
+        return result
+
+    disk_cache = DISK_CACHE
+    if disk_cache is not None:
+        result = disk_cache.get(cache_key)
+        if result is not None:
+            log_to_output("formatting result from disk cache")
+            FORMAT_CACHE.put(cache_key, result)
+            return result
+
+    if use_process_pool:
+        formatter = None
+        if auto_engine:
+            formatter = _get_engine_config(
+                tools, config, document_path, len(source)
+            ).ufmt_config.formatter.name
+        result = _submit_to_process_pool(
+            worker.format_bytes,
+            os.fspath(document_path),
+            source,
+            config.fingerprint,
+            formatter,
+        ).result()
+        _count_process_pool_request()
+    else:
+        result = _ufmt_bytes_by_stage(tools, config, document_path, source, auto_engine)
+        _count_in_process_request()
+    FORMAT_CACHE.put(cache_key, result)
+    if disk_cache is not None:
+        disk_cache.put(cache_key, result)
+    return result
+
+
+def _ufmt_bytes(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    source: bytes,
+) -> bytes:
+    """Runs ufmt on the source with the resolved configs."""
+    return tools.ufmt.ufmt_bytes(
+        document_path,
+        source,
+        encoding="utf-8",
+        ufmt_config=config.ufmt_config,
+        # ufmt pops from target_versions when formatting with ruff-api,
+        # so never hand it the cached set.
+        black_config=dataclasses.replace(
+            config.black_config,
+            target_versions=set(config.black_config.target_versions),
+        ),
+        usort_config=config.usort_config,
+    )
+
+
+def _ufmt_bytes_by_stage(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    source: bytes,
+    auto_engine: bool = False,
+) -> bytes:
+    """Runs the sorter and then the formatter, caching the result of each stage.
+
+    Sorting only looks at the top of the source holding the imports, so edits
+    below the imports reuse the sorted imports, and edits that leave the
+    source the same after sorting reuse the formatter output.
+    """
+    if config.ufmt_config.sorter.name == "usort":
+        source = _sort_imports(tools, config, document_path, source)
+    elif config.ufmt_config.sorter.name != "skip":
+        return _ufmt_bytes(tools, config, document_path, source)
+
+    if auto_engine:
+        config = _get_engine_config(tools, config, document_path, len(source))
+    ufmt_config = config.ufmt_config
+    cache_key = _format_cache_key(
+        source,
+        document_path.suffix,
+        config.fingerprint,
+        tools.versions,
+        f"formatter:{ufmt_config.formatter.name}",
+    )
+    result = STAGE_CACHE.get(cache_key)
+    FORMAT_STATS.record_cache("formatter", result is not None)
+    if result is None:
+        start = time.perf_counter()
+        result = _ufmt_bytes(
+            tools,
+            dataclasses.replace(
+                config,
+                ufmt_config=dataclasses.replace(
+                    ufmt_config, sorter=tools.ufmt.types.Sorter.skip
+                ),
+            ),
+            document_path,
+            source,
+        )
+        if auto_engine and ufmt_config.formatter.name == "black":
+            _record_black_speed(len(source), time.perf_counter() - start)
+        STAGE_CACHE.put(cache_key, result)
+    return result
+
+
+# *****************************************************
+# Automatic formatter selection.
+# *****************************************************
+# Longest time black should take on a document before ruff-api is used.
+AUTO_ENGINE_BUDGET = 0.2
+# Bytes of source black formats per second on this machine, measured at
+# warm-up and refined by every document it formats.
+BLACK_SPEED: float | None = None
+# Weight of each new measurement in BLACK_SPEED.
+BLACK_SPEED_WEIGHT = 0.2
+CALIBRATION_SOURCE = b"".join(
+    b"def function_%d(argument, *args, **kwargs):\n"
+    b"    values = {'key': argument, 'args': args, 'count': %d}\n"
+    b"    return [value for value in values.items() if value]\n\n\n" % (n, n)
+    for n in range(200)
+)
+
+
+def _get_engine_config(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    size: int,
+) -> FormatConfig:
+    """Returns the config to format a document of the given size with.
+
+    Switches from black to ruff-api when black is expected to take longer
+    than the budget, and ruff-api can produce the same formatting.
+    """
+    speed = BLACK_SPEED
+    if (
+        speed is None
+        or size <= speed * AUTO_ENGINE_BUDGET
+        or config.ufmt_config.formatter.name != "black"
+        or not _ruff_api_matches_black(tools, config, document_path)
+    ):
+        return config
+
+    log_to_output(f"formatting {size} bytes with ruff-api")
+    return dataclasses.replace(
+        config,
+        ufmt_config=dataclasses.replace(
+            config.ufmt_config, formatter=tools.ufmt.types.Formatter.ruff_api
+        ),
+    )
+
+
+def _ruff_api_matches_black(
+    tools: ToolEnvironment, config: FormatConfig, document_path: pathlib.Path
+) -> bool:
+    """Returns true if ruff-api supports every black option in the config."""
+    black_config = config.black_config
+    return (
+        tools.ruff_api is not None
+        and document_path.suffix == ".py"
+        and black_config.string_normalization
+        and black_config.magic_trailing_comma
+        and not black_config.is_ipynb
+        and not black_config.skip_source_first_line
+        and not black_config.preview
+        and not black_config.unstable
+        and len(black_config.target_versions) <= 1
+    )
+
+
+def _record_black_speed(size: int, seconds: float) -> None:
+    """Folds the time black took to format a document into BLACK_SPEED."""
+    global BLACK_SPEED  # pylint: disable=global-statement
+    # Small documents are dominated by fixed costs, not by their size.
+    if seconds <= 0 or size < len(CALIBRATION_SOURCE):
+        return
+    speed = size / seconds
+    if BLACK_SPEED is None:
+        BLACK_SPEED = speed
+    else:
+        BLACK_SPEED += (speed - BLACK_SPEED) * BLACK_SPEED_WEIGHT
+
+
+def _calibrate_engines(tools: ToolEnvironment) -> None:
+    """Measures how fast black formats code on this machine."""
+    start = time.perf_counter()
+    try:
+        tools.black.format_file_contents(
+            CALIBRATION_SOURCE.decode("utf-8"), fast=False, mode=tools.black.Mode()
+        )
+    except tools.black.NothingChanged:
+        pass
+    _record_black_speed(len(CALIBRATION_SOURCE), time.perf_counter() - start)
+    log_to_output(
+        f"black formats {BLACK_SPEED / 1024:.0f} KB/s, using ruff-api for"
+        f" documents over {BLACK_SPEED * AUTO_ENGINE_BUDGET / 1024:.0f} KB"
+    )
+
+
+# Lines starting an import statement, at any indentation.
+IMPORT_STATEMENT_RE = re.compile(rb"^[ \t]*(?:import|from)[ \t]", re.MULTILINE)
+# Lines starting a new top-level statement, rather than continuing one.
+TOP_LEVEL_LINE_RE = re.compile(rb"^[^\s#)\]}]", re.MULTILINE)
+
+
+def _sort_imports(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    source: bytes,
+) -> bytes:
+    """Sorts imports with usort, reusing the result for an unchanged top of the source.
+
+    Only the source up to the first top-level statement after the last import
+    is sorted, since nothing below it is changed by sorting. If that part
+    can't be sorted on its own, the whole source is sorted instead. Sorting
+    it alone can only differ in the indentation usort picks for wrapped
+    imports, which the formatter stage replaces anyway.
+    """
+    last_import = None
+    for last_import in IMPORT_STATEMENT_RE.finditer(source):
+        pass
+    if last_import is None:
+        return source
+
+    line_end = source.find(b"\n", last_import.end())
+    tail = TOP_LEVEL_LINE_RE.search(source, line_end + 1) if line_end >= 0 else None
+    split = tail.start() if tail is not None else len(source)
+    head = source[:split]
+
+    cache_key = _format_cache_key(
+        head, document_path.suffix, config.fingerprint, tools.versions, "sort"
+    )
+    result = STAGE_CACHE.get(cache_key)
+    FORMAT_STATS.record_cache("sort", result is not None)
+    if result is None:
+        sorted_result = tools.usort.usort(head, config.usort_config, document_path)
+        if sorted_result.error and split < len(source):
+            # The split fell inside a statement, such as a multi-line string.
+            head, split = source, len(source)
+            sorted_result = tools.usort.usort(head, config.usort_config, document_path)
+        if sorted_result.error:
+            raise sorted_result.error
+        result = sorted_result.output
+        if split == len(source):
+            cache_key = _format_cache_key(
+                head, document_path.suffix, config.fingerprint, tools.versions, "sort"
+            )
+        STAGE_CACHE.put(cache_key, result)
+    return result + source[split:]
+
+
+IMPORT_LINE_RE = re.compile(r"(?:import|from)\s")
+
+
+def _get_import_block(source: str) -> tuple[int, int] | None:
+    """Returns the first and last line of top-level imports in the source."""
+    lines = [
+        index
+        for index, line in enumerate(_split_lines(source))
+        if IMPORT_LINE_RE.match(line)
+    ]
+    if lines:
+        return lines[0], lines[-1]
+    return None
+
+
+def _format_lines(
+    tools: ToolEnvironment,
+    config: FormatConfig,
+    document_path: pathlib.Path,
+    source: str,
+    line_range: tuple[int, int],
+) -> bytes | None:
+    """Formats the zero-based, inclusive range of lines in the source.
+
+    Imports are only sorted when the range covers the whole import block.
+    Returns None if the configured formatter and sorter can't be limited to
+    a range of lines, so that the caller can format the whole document.
+    """
+    ufmt_config = config.ufmt_config
+    if (
+        ufmt_config.formatter.name != "black"
+        or ufmt_config.sorter.name not in ("usort", "skip")
+        or not hasattr(tools.black, "parse_line_ranges")
+    ):
+        return None
+
+    start, end = line_range
+    content = source.encode("utf-8")
+    import_block = _get_import_block(source)
+    if (
+        ufmt_config.sorter.name == "usort"
+        and import_block is not None
+        and start <= import_block[0]
+        and import_block[1] <= end
+    ):
+        sorted_result = tools.usort.usort(content, config.usort_config, document_path)
+        if sorted_result.error:
+            raise sorted_result.error
+        # Sorting can merge or split imports, so follow the end of the range.
+        end += sorted_result.output.count(b"\n") - content.count(b"\n")
+        content = sorted_result.output
+
+    black_config = config.black_config
+    if document_path.suffix == ".pyi":
+        black_config = dataclasses.replace(black_config, is_pyi=True)
+
+    content_str = content.decode("utf-8")
+    try:
+        content_str = tools.black.format_file_contents(
+            content_str,
+            fast=False,
+            mode=black_config,
+            lines=[(start + 1, max(start, end) + 1)],
+        )
+    except tools.black.NothingChanged:
+        pass
+    return content_str.encode("utf-8")
+
+
+# *****************************************************
+# Tool environment.
+# *****************************************************
+@dataclasses.dataclass(frozen=True)
+class ToolEnvironment:
+    """Tool modules and versions used for in-process formatting."""
+
+    ufmt: types.ModuleType
+    black: types.ModuleType
+    libcst: types.ModuleType
+    usort: types.ModuleType
+    trailrunner: types.ModuleType
+    ruff_api: types.ModuleType | None
+    versions: str
+
+
+TOOL_ENVIRONMENTS: dict[tuple[str, str], ToolEnvironment] = {}
+TOOL_ENVIRONMENT_LOCK = threading.Lock()
+
+
+def _get_tool_environment() -> ToolEnvironment | None:
+    """Returns the tools for the current interpreter and import strategy.
+
+    Tools are imported and checked once, and the same snapshot is reused for
+    every request. Logs an error and returns None if the tools can't be used.
+    """
+    key = (sys.executable, IMPORT_STRATEGY)
+    with TOOL_ENVIRONMENT_LOCK:
+        tools = TOOL_ENVIRONMENTS.get(key)
+        if tools is not None:
+            return tools
+
+        try:
+            tools = _load_tool_environment()
+        except UfmtError as e:
+            log_error(str(e))
+            return None
+        except Exception:  # pylint: disable=broad-except
+            log_error("failed to import tools:\n" + traceback.format_exc(chain=True))
+            return None
+
+        log_to_output(f"active versions:  {tools.versions}")
+        TOOL_ENVIRONMENTS[key] = tools
+        return tools
+
+
+SYS_PATH_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _bundled_sys_path():
+    """Puts the bundled libraries on sys.path while importing or warming up tools.
+
+    sys.path is shared by every thread, so only one thread may swap it at a time.
+    """
+    with SYS_PATH_LOCK:
+        # This is needed to preserve sys.path, in cases where the tool modifies
+        # sys.path and that might not work for this scenario next time around.
+        with utils.substitute_attr(sys, "path", sys.path[:]):
+            with update_sys_path(BUNDLED_LIBS, IMPORT_STRATEGY):
+                yield
+
+
+def _load_tool_environment() -> ToolEnvironment:
+    """Imports the tools and checks that they are compatible with the server."""
+    with _bundled_sys_path():
+        import ufmt
+
+        if ufmt.__version__.startswith("1."):
+            raise UfmtError(
+                "ufmt >= 2.0 required, upgrade environment "
+                'or set import strategy to "useBundled"'
+            )
+
+        import black
+        import libcst
+        import trailrunner
+        import ufmt.util
+        import usort
+
+        try:
+            import ruff_api
+
+            ruff_api_version = ruff_api.__version__
+        except ImportError as e:
+            log_to_output(f"ruff-api failed to import: {e}")
+            ruff_api = None
+            ruff_api_version = "None"
+
+    return ToolEnvironment(
+        ufmt=ufmt,
+        black=black,
+        libcst=libcst,
+        usort=usort,
+        trailrunner=trailrunner,
+        ruff_api=ruff_api,
+        versions=(
+            f"ufmt=={ufmt.__version__}"
+            f"  black=={black.__version__}"
+            f"  libcst=={libcst.LIBCST_VERSION}"
+            f"  ruff-api=={ruff_api_version}"
+            f"  usort=={usort.__version__}"
+        ),
+    )
+
+
+# *****************************************************
+# Config resolution and caching.
+# *****************************************************
+@dataclasses.dataclass(frozen=True)
+class FormatConfig:
+    """Resolved ufmt, black, and usort configs for a directory."""
+
+    ufmt_config: object
+    black_config: object
+    usort_config: object
+    fingerprint: str
+    stamp: tuple = ()
+
+
+CONFIG_CACHE: dict[str, FormatConfig] = {}
+CONFIG_CACHE_LOCK = threading.Lock()
+CONFIG_FILE_NAMES = ("pyproject.toml", "setup.cfg")
+
+# Set once the client watches config files for us; until then cached configs
+# are checked against the config files on disk before each use.
+WATCHING_CONFIG_FILES = False
+
+
+def _get_format_config(
+    tools: ToolEnvironment, document_path: pathlib.Path, mode: str | None = None
+) -> FormatConfig:
+    """Returns the resolved configs for a document, resolving them on first use.
+
+    Every config the tools look up depends only on the document's directory, so
+    results are cached per directory rather than per file.
+
+    If mode is given, cache use and the time spent resolving each config are
+    recorded in the stats for that execution mode.
+    """
+    key = os.fspath(document_path.parent)
+    stamp = _config_stamp(document_path)
+    with CONFIG_CACHE_LOCK:
+        config = CONFIG_CACHE.get(key)
+    hit = config is not None and config.stamp == stamp
+    if mode is not None:
+        FORMAT_STATS.record_cache("config", hit)
+    if hit:
+        return config
+
+    _clear_tool_config_caches()
+    with FORMAT_STATS.timer(mode, "loadConfig"):
+        ufmt_config = tools.ufmt.config.load_config(document_path)
+    with FORMAT_STATS.timer(mode, "makeBlackConfig"):
+        black_config = tools.ufmt.util.make_black_config(document_path)
+    with FORMAT_STATS.timer(mode, "findUsortConfig"):
+        usort_config = tools.ufmt.types.UsortConfig.find(document_path)
+    config = FormatConfig(
+        ufmt_config=ufmt_config,
+        black_config=black_config,
+        usort_config=usort_config,
+        fingerprint=_config_fingerprint(ufmt_config, black_config, usort_config),
+        stamp=stamp,
+    )
+    with CONFIG_CACHE_LOCK:
+        CONFIG_CACHE[key] = config
+    return config
+
+
+def _config_stamp(document_path: pathlib.Path) -> tuple:
+    """Returns what results for a document are checked against to stay current.
+
+    Once the client watches config files, changes are reported and results are
+    dropped, so there is nothing to check.
+    """
+    return () if WATCHING_CONFIG_FILES else _config_files_stamp(document_path)
+
+
+def _config_files_stamp(document_path: pathlib.Path) -> tuple:
+    """Returns the size and mtime of every config file above a document."""
+    stamp = []
+    for directory in document_path.parents:
+        for name in CONFIG_FILE_NAMES:
+            try:
+                stat = os.stat(directory / name)
+            except OSError:
+                continue
+            stamp.append((os.fspath(directory), name, stat.st_size, stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+def _clear_tool_config_caches() -> None:
+    """Drops the config and project root caches kept by ufmt and black."""
+    for module_name, function_name in (
+        ("ufmt.config", "load_config"),
+        ("black.files", "find_project_root"),
+        ("black.files", "_load_toml"),
+    ):
+        function = getattr(sys.modules.get(module_name), function_name, None)
+        if hasattr(function, "cache_clear"):
+            function.cache_clear()
+
+
+def _invalidate_config_cache(config_path: str) -> None:
+    """Drops cached configs, and pre-formatted edits, under a changed config file."""
+    root = os.fspath(pathlib.Path(config_path).resolve().parent)
+    prefix = os.path.join(root, "")
+    with CONFIG_CACHE_LOCK:
+        for key in [k for k in CONFIG_CACHE if k == root or k.startswith(prefix)]:
+            del CONFIG_CACHE[key]
+    with PREFORMAT_LOCK:
+        for uri in list(PREFORMAT_RESULTS):
+            path = uris.to_fs_path(uri)
+            if path and os.path.realpath(path).startswith(prefix):
+                del PREFORMAT_RESULTS[uri]
+
+
+def _config_fingerprint(ufmt_config, black_config, usort_config) -> str:
+    """Returns a stable digest of the resolved ufmt, black, and usort configs."""
+    # usort's `known` mapping is seeded from a set, so sort it to keep the
+    # fingerprint independent of hash randomization.
+    usort_config = dataclasses.replace(
+        usort_config, known=dict(sorted(usort_config.known.items()))
+    )
+    fingerprint = "\0".join(
+        [repr(ufmt_config), black_config.get_cache_key(), repr(usort_config)]
+    )
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+def _format_cache_key(
+    source: bytes,
+    suffix: str,
+    config_fingerprint: str,
+    tool_versions: str,
+    stage: str = "",
+) -> str:
+    """Returns the content-addressed key for formatting `source` with a config.
+
+    Keys for the sort or format stage alone are told apart by the stage name.
+    """
+    digest = hashlib.sha256(source)
+    digest.update(
+        f"\0{suffix}\0{config_fingerprint}\0{tool_versions}\0{stage}".encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def _set_format_cache_size(size: float) -> None:
+    """Sets the size in MB of the in-memory caches for documents and stages."""
+    FORMAT_CACHE.max_bytes = STAGE_CACHE.max_bytes = int(size * 1024 * 1024)
+
+
+# Number of in-process formats between checks of the server's memory.
+MEMORY_CHECK_INTERVAL = 100
+IN_PROCESS_REQUESTS = 0
+IN_PROCESS_REQUESTS_LOCK = threading.Lock()
+
+
+def _count_in_process_request() -> None:
+    """Counts an in-process format, trimming caches if the server grew too large.
+
+    The server can't be replaced like a runner, so once its resident memory
+    passes ufmt.maxRunnerMemory the caches it and the tools keep are dropped.
+    """
+    global IN_PROCESS_REQUESTS  # pylint: disable=global-statement
+    with IN_PROCESS_REQUESTS_LOCK:
+        IN_PROCESS_REQUESTS += 1
+        if IN_PROCESS_REQUESTS % MEMORY_CHECK_INTERVAL:
+            return
+
+    max_memory = _get_settings_by_document(None)["maxRunnerMemory"] * 1024 * 1024
+    rss = utils.get_rss()
+    if not max_memory or rss is None or rss < max_memory:
+        return
+    log_to_output(f"server is using {rss // (1024 * 1024)} MB, clearing caches")
+    FORMAT_CACHE.clear()
+    STAGE_CACHE.clear()
+    with CONFIG_CACHE_LOCK:
+        CONFIG_CACHE.clear()
+    _clear_tool_config_caches()
+    gc.collect()
+
+
+# *****************************************************
+# On-disk format cache.
+# *****************************************************
+DISK_CACHE: cache.DiskFormatCache | None = None
+DISK_CACHE_LOCK = threading.Lock()
+DISK_CACHE_FILE_NAME = "format-cache.sqlite3"
+
+
+def _configure_disk_cache(size: float) -> None:
+    """Opens, resizes, or closes the on-disk format cache to match its size in MB."""
+    global DISK_CACHE  # pylint: disable=global-statement
+    max_bytes = int(size * 1024 * 1024)
+    if max_bytes <= 0:
+        _close_disk_cache()
+        return
+
+    with DISK_CACHE_LOCK:
+        if DISK_CACHE is not None:
+            DISK_CACHE.max_bytes = max_bytes
+            return
+
+        path = os.path.join(utils.get_user_cache_dir(UFMT_NAME), DISK_CACHE_FILE_NAME)
+        try:
+            DISK_CACHE = cache.DiskFormatCache(path, max_bytes)
+        except Exception as e:  # pylint: disable=broad-except
+            log_warning(f"failed to open format cache {path}: {e}")
+            return
+        log_to_output(f"using format cache {path}")
+
+
+def _close_disk_cache() -> None:
+    """Closes the on-disk format cache, if open."""
+    global DISK_CACHE  # pylint: disable=global-statement
+    with DISK_CACHE_LOCK:
+        if DISK_CACHE is not None:
+            DISK_CACHE.close()
+            DISK_CACHE = None
+
+
+# *****************************************************
+# Process pool.
+# *****************************************************
+PROCESS_POOL: concurrent.futures.ProcessPoolExecutor | None = None
+PROCESS_POOL_LOCK = threading.Lock()
+PROCESS_POOL_SIZE = 1
+# Formats run on the current pool, counted to recycle its workers.
+POOL_REQUESTS = 0
+
+
+def _get_process_pool_size(size: float) -> int:
+    """Returns the number of worker processes, leaving a core for the editor."""
+    size = int(size)
+    if size > 0:
+        return size
+    return max((os.cpu_count() or 2) - 1, 1)
+
+
+def _get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the pool of worker processes, starting and warming them up on first use."""
+    global PROCESS_POOL  # pylint: disable=global-statement
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is None:
+            PROCESS_POOL, _ = _start_process_pool()
+        return PROCESS_POOL
+
+
+def _submit_to_process_pool(fn, *args) -> concurrent.futures.Future:
+    """Submits work to the pool of worker processes, starting it on first use.
+
+    The pool is looked up and submitted to under the lock, so a recycle can't
+    swap it out and shut it down in between.
+    """
+    global PROCESS_POOL  # pylint: disable=global-statement
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is None:
+            PROCESS_POOL, _ = _start_process_pool()
+        return PROCESS_POOL.submit(fn, *args)
+
+
+def _start_process_pool() -> (
+    tuple[concurrent.futures.ProcessPoolExecutor, list[concurrent.futures.Future]]
+):
+    """Starts a pool of worker processes, returning it and their warm-ups."""
+    log_to_output(f"starting process pool with {PROCESS_POOL_SIZE} workers")
+    # Forking a process with running threads is unsafe, so always spawn.
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=PROCESS_POOL_SIZE,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=worker.initialize,
+        initargs=(BUNDLED_LIBS, IMPORT_STRATEGY),
+    )
+    # Spawned workers re-run the parent's main module before unpickling
+    # any work. Point them at the worker module instead of this one, so
+    # they don't build a language server of their own. Workers start as
+    # work is submitted, so start them all here with a warm-up each.
+    with utils.substitute_attr(sys.modules["__main__"], "__spec__", worker.__spec__):
+        futures = [pool.submit(worker.warm_up) for _ in range(PROCESS_POOL_SIZE)]
+    for future in futures:
+        future.add_done_callback(_log_worker_warm_up)
+    return pool, futures
+
+
+def _count_process_pool_request() -> None:
+    """Counts a format run on the pool, recycling its workers after too many.
+
+    Each worker is allowed ufmt.maxRunnerRequests formats on average. Fresh
+    workers are started and warmed up while the old ones keep serving.
+    """
+    global POOL_REQUESTS  # pylint: disable=global-statement
+    max_requests = _get_settings_by_document(None)["maxRunnerRequests"]
+    with PROCESS_POOL_LOCK:
+        POOL_REQUESTS += 1
+        if not max_requests or POOL_REQUESTS != max_requests * PROCESS_POOL_SIZE:
+            return
+        old_pool = PROCESS_POOL
+    if old_pool is not None:
+        threading.Thread(
+            target=_recycle_process_pool,
+            args=(old_pool,),
+            name="ufmt-pool-recycle",
+            daemon=True,
+        ).start()
+
+
+def _recycle_process_pool(old_pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    """Replaces the pool with fresh workers once they are warm."""
+    global PROCESS_POOL, POOL_REQUESTS  # pylint: disable=global-statement
+    log_to_output("recycling process pool workers")
+    pool, warm_ups = _start_process_pool()
+    concurrent.futures.wait(warm_ups)
+    with PROCESS_POOL_LOCK:
+        # The pool may have been shut down or replaced in the meantime.
+        replaced = PROCESS_POOL is old_pool
+        if replaced:
+            PROCESS_POOL = pool
+            POOL_REQUESTS = 0
+    # Formats already submitted to the old workers still finish.
+    (old_pool if replaced else pool).shutdown(wait=False)
+
+
+def _log_worker_warm_up(future: concurrent.futures.Future) -> None:
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        log_to_output(f"process pool warm-up failed:\n{future.exception()}")
+    else:
+        log_to_output(f"process pool worker {future.result()} ready")
+
+
+def _shutdown_process_pool() -> None:
+    """Stops the worker processes, if started, and waits for them to exit."""
+    global PROCESS_POOL, POOL_REQUESTS  # pylint: disable=global-statement
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is not None:
+            PROCESS_POOL.shutdown(wait=True, cancel_futures=True)
+            PROCESS_POOL = None
+            POOL_REQUESTS = 0
+
+
+# *****************************************************
+# Background warm-up.
+# *****************************************************
+WARM_UP: threading.Thread | None = None
+WARM_UP_SOURCE = b"import os\n"
+
+
+def _start_runners() -> None:
+    """Starts runners for workspaces using other interpreters ahead of use."""
+    for settings in list(WORKSPACE_SETTINGS.values()):
+        if _get_execution_mode(settings) != "rpc":
+            continue
+        try:
+            jsonrpc.start_runners(settings["interpreter"], settings["workspaceFS"])
+        except OSError as e:
+            log_error(f"failed to start runner for {settings['workspaceFS']}: {e}")
+
+
+def _start_warm_up() -> None:
+    """Starts warming up the in-process formatters in the background."""
+    global WARM_UP  # pylint: disable=global-statement
+    WARM_UP = threading.Thread(target=_warm_up, name="ufmt-warm-up", daemon=True)
+    WARM_UP.start()
+
+
+def _wait_for_warm_up() -> None:
+    """Blocks until a running warm-up has finished, so its work isn't repeated."""
+    if WARM_UP is not None:
+        WARM_UP.join()
+
+
+def _warm_up() -> None:
+    """Loads the tools, resolves workspace configs, and runs a tiny format."""
+    modes = {
+        settings["workspaceFS"]: _get_execution_mode(settings)
+        for settings in WORKSPACE_SETTINGS.values()
+    }
+    workspaces = [
+        workspace_path
+        for workspace_path, mode in modes.items()
+        if mode in ("in-process", "process-pool")
+    ]
+    if not workspaces:
+        return
+
+    if "process-pool" in modes.values():
+        _get_process_pool()
+
+    tools = _get_tool_environment()
+    if tools is None:
+        return
+
+    auto_engine = any(
+        settings["engine"] == "auto" for settings in WORKSPACE_SETTINGS.values()
+    )
+
+    with _bundled_sys_path():
+        try:
+            for workspace_path in workspaces:
+                # Configs are resolved per directory, so a placeholder file
+                # in the workspace root warms the config for its top level.
+                document_path = pathlib.Path(workspace_path).resolve() / "_.py"
+                config = _get_format_config(tools, document_path)
+                _ufmt_bytes(tools, config, document_path, WARM_UP_SOURCE)
+            # Calibrate once black is warm, so first use costs aren't counted.
+            if auto_engine and BLACK_SPEED is None and tools.ruff_api is not None:
+                _calibrate_engines(tools)
+        except Exception:  # pylint: disable=broad-except
+            log_to_output("warm-up failed:\n" + traceback.format_exc())
+            return
+
+    log_to_output("warm-up complete")
+
+
 # *****************************************************
 # Logging and notification.
 # *****************************************************
@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""Latency and cache statistics for formatting requests."""
+
+from __future__ import annotations
+
+import collections
+import contextlib
+import threading
+import time
+
+
+class FormatStats:
+    """Rolling latency samples per execution mode and phase, and cache counters.
+
+    Only the most recent `window` samples of each phase are kept for
+    percentiles, while counts cover every sample since the last `clear()`.
+    """
+
+    def __init__(self, window: int = 1024):
+        self._window = window
+        self._samples: dict[tuple[str, str], collections.deque[float]] = {}
+        self._counts: collections.Counter[tuple[str, str]] = collections.Counter()
+        self._cache_counts: collections.Counter[tuple[str, bool]] = (
+            collections.Counter()
+        )
+        self._lock = threading.Lock()
+
+    def record(self, mode: str | None, phase: str, seconds: float) -> None:
+        """Records how long a phase took for a request in the given mode.
+
+        Nothing is recorded if mode is None, such as for background work.
+        """
+        if mode is None:
+            return
+        key = (mode, phase)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = collections.deque(maxlen=self._window)
+            samples.append(seconds)
+            self._counts[key] += 1
+
+    @contextlib.contextmanager
+    def timer(self, mode: str | None, phase: str):
+        """Records the time spent in the body of the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(mode, phase, time.perf_counter() - start)
+
+    def record_cache(self, cache: str, hit: bool) -> None:
+        """Counts a hit or miss for the named cache."""
+        with self._lock:
+            self._cache_counts[(cache, hit)] += 1
+
+    def cache_counts(self, cache: str) -> tuple[int, int]:
+        """Returns the hits and misses counted for the named cache."""
+        with self._lock:
+            return self._cache_counts[(cache, True)], self._cache_counts[(cache, False)]
+
+    def latencies(self) -> dict[str, dict[str, dict[str, float]]]:
+        """Returns count and p50/p95/p99 in milliseconds, by mode and phase."""
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+            counts = dict(self._counts)
+
+        result: dict[str, dict[str, dict[str, float]]] = {}
+        for (mode, phase), values in sorted(samples.items()):
+            result.setdefault(mode, {})[phase] = {
+                "count": counts[(mode, phase)],
+                "p50": _percentile(values, 50) * 1000,
+                "p95": _percentile(values, 95) * 1000,
+                "p99": _percentile(values, 99) * 1000,
+            }
+        return result
+
+    def clear(self) -> None:
+        """Drops all samples and counters."""
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._cache_counts.clear()
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    """Returns the nearest-rank percentile of sorted values."""
+    rank = -(-len(values) * percent // 100)
+    return values[max(rank, 1) - 1]
@@ -52,6 +52,31 @@ def is_stdlib_file(file_path) -> bool:
     return os.path.normcase(os.path.normpath(file_path)).startswith(_site_paths)
 
 
+def get_rss() -> int | None:
+    """Returns the resident memory of this process in bytes, if it can be found.
+
+    Only /proc reports the current resident memory without extra dependencies,
+    so elsewhere this returns None and memory limits are not checked. The peak
+    from getrusage is no substitute, as it never goes back down.
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_user_cache_dir(name: str) -> str:
+    """Returns the per-user cache directory for the given application name."""
+    if sys.platform == "win32":
+        root = os.getenv("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+        return os.path.join(root, name, "Cache")
+    if sys.platform == "darwin":
+        return os.path.join(os.path.expanduser("~/Library/Caches"), name)
+    root = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(root, name)
+
+
 # pylint: disable-next=too-few-public-methods
 class RunResult:
     """Object to hold result from running tool."""
@@ -0,0 +1,140 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Process pool worker for formatting outside of the language server process.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import multiprocessing
+import os
+import pathlib
+import sys
+import threading
+import traceback
+
+# Tool modules, imported once by `initialize()` when the worker starts.
+ufmt = None
+libcst = None
+
+# Resolved configs keyed on document directory and the server's fingerprint
+# for them, so that config changes seen by the server reach the worker.
+CONFIGS = {}
+
+WARM_UP_SOURCE = b"import os\n"
+
+
+class WorkerError(Exception):
+    """Formatting failed in the worker; carries the formatted traceback."""
+
+
+def initialize(bundled_libs: str, import_strategy: str) -> None:
+    """Imports the tools once when a worker process starts."""
+    global ufmt, libcst  # pylint: disable=global-statement
+
+    # Workers inherit the server's stdio, which carries the LSP connection.
+    # Detach from it so that stray output can't corrupt messages, and so the
+    # client sees the connection close when the server exits.
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    if devnull > 1:
+        os.close(devnull)
+
+    # If the server is killed without shutting down the pool, workers would
+    # wait for work forever, so exit along with it.
+    parent = multiprocessing.parent_process()
+    if parent is not None:
+        threading.Thread(
+            target=_exit_with_parent, args=(parent,), name="ufmt-parent", daemon=True
+        ).start()
+
+    if bundled_libs not in sys.path and os.path.isdir(bundled_libs):
+        if import_strategy == "useBundled":
+            sys.path.insert(0, bundled_libs)
+        elif import_strategy == "fromEnvironment":
+            sys.path.append(bundled_libs)
+
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import libcst
+    import ufmt
+    import ufmt.util
+
+
+def _exit_with_parent(parent) -> None:
+    parent.join()
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def warm_up() -> int:
+    """Runs a tiny format to load any lazily imported tool internals.
+
+    Returns the worker's process id.
+    """
+    document_path = pathlib.Path.cwd() / "_.py"
+    format_bytes(os.fspath(document_path), WARM_UP_SOURCE, "")
+    return os.getpid()
+
+
+def format_bytes(
+    document_path: str,
+    source: bytes,
+    config_fingerprint: str,
+    formatter: str | None = None,
+) -> bytes:
+    """Formats source for the given document path.
+
+    If formatter is given, it names the formatter to use instead of the one
+    in the project's ufmt config.
+
+    Syntax errors are raised as `SyntaxError`, and any other failure as a
+    `WorkerError`, so that errors can always be sent back to the server.
+    """
+    path = pathlib.Path(document_path)
+    try:
+        ufmt_config, black_config, usort_config = _get_configs(path, config_fingerprint)
+        if formatter is not None:
+            ufmt_config = dataclasses.replace(
+                ufmt_config, formatter=ufmt.types.Formatter[formatter]
+            )
+        return ufmt.ufmt_bytes(
+            path,
+            source,
+            encoding="utf-8",
+            ufmt_config=ufmt_config,
+            # ufmt pops from target_versions when formatting with ruff-api,
+            # so never hand it the cached set.
+            black_config=dataclasses.replace(
+                black_config, target_versions=set(black_config.target_versions)
+            ),
+            usort_config=usort_config,
+        )
+    except (libcst.ParserSyntaxError, SyntaxError) as e:
+        raise SyntaxError(str(e)) from None
+    except Exception:  # pylint: disable=broad-except
+        raise WorkerError(traceback.format_exc(chain=True)) from None
+
+
+def _get_configs(path: pathlib.Path, config_fingerprint: str):
+    directory = os.fspath(path.parent)
+    configs = CONFIGS.get((directory, config_fingerprint))
+    if configs is None:
+        for key in [k for k in CONFIGS if k[0] == directory]:
+            del CONFIGS[key]
+        for module_name, function_name in (
+            ("ufmt.config", "load_config"),
+            ("black.files", "find_project_root"),
+            ("black.files", "_load_toml"),
+        ):
+            function = getattr(sys.modules.get(module_name), function_name, None)
+            if hasattr(function, "cache_clear"):
+                function.cache_clear()
+
+        configs = (
+            ufmt.config.load_config(path),
+            ufmt.util.make_black_config(path),
+            ufmt.types.UsortConfig.find(path),
+        )
+        CONFIGS[(directory, config_fingerprint)] = configs
+    return configs
@@ -14,6 +14,18 @@ export interface ISettings {
     interpreter: string[];
     importStrategy: string;
     showNotifications: string;
+    formatCacheSize: number;
+    diskCacheSize: number;
+    maxTextEdits: number;
+    formatDeadline: number;
+    executionMode: string;
+    processPoolSize: number;
+    minRunners: number;
+    maxRunners: number;
+    maxRunnerRequests: number;
+    maxRunnerMemory: number;
+    engine: string;
+    preformat: boolean;
 }
 
 export async function getExtensionSettings(namespace: string, includeInterpreter?: boolean): Promise<ISettings[]> {
@@ -56,6 +68,18 @@ export async function getWorkspaceSettings(
         interpreter: interpreter ?? [],
         importStrategy: config.get<string>(`importStrategy`) ?? 'fromEnvironment',
         showNotifications: config.get<string>(`showNotifications`) ?? 'off',
+        formatCacheSize: config.get<number>(`formatCacheSize`) ?? 32,
+        diskCacheSize: config.get<number>(`diskCacheSize`) ?? 0,
+        maxTextEdits: config.get<number>(`maxTextEdits`) ?? 100,
+        formatDeadline: config.get<number>(`formatDeadline`) ?? 5000,
+        executionMode: config.get<string>(`executionMode`) ?? 'inProcess',
+        processPoolSize: config.get<number>(`processPoolSize`) ?? 0,
+        minRunners: config.get<number>(`minRunners`) ?? 1,
+        maxRunners: config.get<number>(`maxRunners`) ?? 2,
+        maxRunnerRequests: config.get<number>(`maxRunnerRequests`) ?? 1000,
+        maxRunnerMemory: config.get<number>(`maxRunnerMemory`) ?? 1024,
+        engine: config.get<string>(`engine`) ?? 'config',
+        preformat: config.get<boolean>(`preformat`) ?? false,
     };
     return workspaceSetting;
 }
@@ -68,7 +92,27 @@ export function checkIfConfigurationChanged(e: ConfigurationChangeEvent, namespa
         `${namespace}.interpreter`,
         `${namespace}.importStrategy`,
         `${namespace}.showNotifications`,
+        `${namespace}.formatCacheSize`,
+        `${namespace}.diskCacheSize`,
+        `${namespace}.maxTextEdits`,
+        `${namespace}.formatDeadline`,
+        `${namespace}.executionMode`,
+        `${namespace}.processPoolSize`,
+        `${namespace}.minRunners`,
+        `${namespace}.maxRunners`,
+        `${namespace}.maxRunnerRequests`,
+        `${namespace}.maxRunnerMemory`,
+        `${namespace}.engine`,
+        `${namespace}.preformat`,
     ];
     const changed = settings.map((s) => e.affectsConfiguration(s));
     return changed.includes(true);
 }
+
+export function checkIfRestartRequired(e: ConfigurationChangeEvent, namespace: string): boolean {
+    // These settings are read when the server process starts, everything else
+    // is sent to the running server.
+    const settings = [`${namespace}.interpreter`, `${namespace}.importStrategy`, `${namespace}.showNotifications`];
+    const changed = settings.map((s) => e.affectsConfiguration(s));
+    return changed.includes(true);
+}
@@ -14,6 +14,7 @@ import {
 } from './common/python';
 import {
     checkIfConfigurationChanged,
+    checkIfRestartRequired,
     getExtensionSettings,
     getInterpreterFromSetting,
     ISettings,
@@ -64,12 +65,26 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
         }),
     );
 
+    context.subscriptions.push(
+        registerCommand(`${serverId}.formatWorkspace`, async () => {
+            if (lsClient) {
+                await lsClient.sendRequest(`${serverId}/formatWorkspace`, {});
+            }
+        }),
+    );
+
     context.subscriptions.push(
         onDidChangeConfiguration(async (e: vscode.ConfigurationChangeEvent) => {
             if (checkIfConfigurationChanged(e, serverId)) {
                 const newSettings = await getExtensionSettings(serverId);
                 setLoggingLevel(newSettings[0].logLevel);
-                await runServer();
+                if (lsClient && !checkIfRestartRequired(e, serverId)) {
+                    await lsClient.sendNotification('workspace/didChangeConfiguration', {
+                        settings: await getExtensionSettings(serverId, true),
+                    });
+                } else {
+                    await runServer();
+                }
             }
         }),
     );
@@ -20,7 +20,11 @@ from .defaults import VSCODE_DEFAULT_INITIALIZE
 LSP_EXIT_TIMEOUT = 5000
 
 
+CLIENT_REGISTER_CAPABILITY = "client/registerCapability"
+PROGRESS = "$/progress"
 PUBLISH_DIAGNOSTICS = "textDocument/publishDiagnostics"
+WINDOW_WORK_DONE_PROGRESS_CREATE = "window/workDoneProgress/create"
+WORKSPACE_APPLY_EDIT = "workspace/applyEdit"
 WINDOW_LOG_MESSAGE = "window/logMessage"
 WINDOW_SHOW_MESSAGE = "window/showMessage"
 
@@ -38,6 +42,7 @@ class LspSession(MethodDispatcher):
         self._reader = None
         self._endpoint = None
         self._notification_callbacks = {}
+        self.applied_edits = []
         self.script = (
             script if script else (PROJECT_ROOT / "bundled" / "tool" / "server.py")
         )
@@ -62,7 +67,11 @@ class LspSession(MethodDispatcher):
         self._reader = JsonRpcStreamReader(os.fdopen(self._sub.stdout.fileno(), "rb"))
 
         dispatcher = {
+            CLIENT_REGISTER_CAPABILITY: self._client_register_capability,
+            PROGRESS: self._progress,
             PUBLISH_DIAGNOSTICS: self._publish_diagnostics,
+            WINDOW_WORK_DONE_PROGRESS_CREATE: self._window_work_done_progress_create,
+            WORKSPACE_APPLY_EDIT: self._workspace_apply_edit,
             WINDOW_SHOW_MESSAGE: self._window_show_message,
             WINDOW_LOG_MESSAGE: self._window_log_message,
         }
@@ -109,7 +118,7 @@ class LspSession(MethodDispatcher):
 
     def initialized(self, initialized_params=None):
         """Sends the initialized notification to LSP server."""
-        self._endpoint.notify("initialized", initialized_params)
+        self._endpoint.notify("initialized", initialized_params or {})
 
     def shutdown(self, should_exit, exit_timeout=LSP_EXIT_TIMEOUT):
         """Sends the shutdown request to LSP server."""
@@ -141,6 +150,58 @@ class LspSession(MethodDispatcher):
         """Sends did close notification to LSP Server."""
         self._send_notification("textDocument/didClose", params=did_close_params)
 
+    def notify_did_change_watched_files(self, did_change_watched_files_params):
+        """Sends did change watched files notification to LSP Server."""
+        self._send_notification(
+            "workspace/didChangeWatchedFiles", params=did_change_watched_files_params
+        )
+
+    def notify_did_open_notebook(self, did_open_notebook_params):
+        """Sends notebook did open notification to LSP Server."""
+        self._send_notification(
+            "notebookDocument/didOpen", params=did_open_notebook_params
+        )
+
+    def notify_did_change_notebook(self, did_change_notebook_params):
+        """Sends notebook did change notification to LSP Server."""
+        self._send_notification(
+            "notebookDocument/didChange", params=did_change_notebook_params
+        )
+
+    def notify_did_change_configuration(self, did_change_configuration_params):
+        """Sends did change configuration notification to LSP Server."""
+        self._send_notification(
+            "workspace/didChangeConfiguration", params=did_change_configuration_params
+        )
+
+    def text_document_formatting(self, formatting_params):
+        """Sends text document formatting request to LSP server."""
+        fut = self._send_request("textDocument/formatting", params=formatting_params)
+        return fut.result()
+
+    def text_document_range_formatting(self, range_formatting_params):
+        """Sends text document range formatting request to LSP server."""
+        fut = self._send_request(
+            "textDocument/rangeFormatting", params=range_formatting_params
+        )
+        return fut.result()
+
+    def send_request(self, name, params=None):
+        """Sends {name} request to the LSP server, returning a future result."""
+        return self._send_request(name, params=params)
+
+    def cancel_request(self, fut):
+        """Sends $/cancelRequest for a request from `send_request`.
+
+        Unlike cancelling the future, this leaves it to be completed by the
+        server's response.
+        """
+        # pylint: disable=protected-access
+        for msg_id, request_future in self._endpoint._server_request_futures.items():
+            if request_future is fut:
+                self._send_notification("$/cancelRequest", {"id": msg_id})
+                return
+
     def set_notification_callback(self, notification_name, callback):
         """Set custom LS notification handler."""
         self._notification_callbacks[notification_name] = callback
@@ -157,6 +218,23 @@ class LspSession(MethodDispatcher):
 
             return _default_handler
 
+    def _client_register_capability(self, _register_capability_params):
+        """Internal handler for client register capability requests."""
+        return None
+
+    def _window_work_done_progress_create(self, _work_done_progress_create_params):
+        """Internal handler for window work done progress create requests."""
+        return None
+
+    def _workspace_apply_edit(self, apply_edit_params):
+        """Internal handler for workspace apply edit requests, recording edits."""
+        self.applied_edits.append(apply_edit_params["edit"])
+        return {"applied": True}
+
+    def _progress(self, progress_params):
+        """Internal handler for progress notifications."""
+        return self._handle_notification(PROGRESS, progress_params)
+
     def _publish_diagnostics(self, publish_diagnostics_params):
         """Internal handler for text document publish diagnostics."""
         return self._handle_notification(
@@ -3,6 +3,7 @@
 """
 Utility functions for use with tests.
 """
+import io
 import json
 import os
 import pathlib
@@ -74,3 +75,21 @@ def get_initialization_options():
     setting["interpreter"] = []
 
     return {"settings": [setting]}
+
+
+def apply_text_edits(text: str, edits) -> str:
+    """Applies LSP text edits, given as JSON, to the text."""
+    lines = io.StringIO(text, newline="").readlines()
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    def _offset(position):
+        line = min(position["line"], len(lines))
+        return offsets[line] + position["character"]
+
+    for edit in sorted(edits, key=lambda e: _offset(e["range"]["start"]), reverse=True):
+        start = _offset(edit["range"]["start"])
+        end = _offset(edit["range"]["end"])
+        text = text[:start] + edit["newText"] + text[end:]
+    return text
@@ -4,9 +4,18 @@
 Test for linting over LSP.
 """
 
+import copy
+import os
+import pathlib
+import re
+import sys
+import tempfile
+import time
 from threading import Event
 
+import pytest
 from hamcrest import assert_that, is_
+from pyls_jsonrpc.exceptions import JsonRpcException, JsonRpcRequestCancelled
 
 from .lsp_test_client import constants, defaults, session, utils
 
@@ -22,7 +31,6 @@ def test_formatting_example():
     UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
 
     contents = UNFORMATTED_TEST_FILE_PATH.read_text()
-    lines = contents.splitlines(keepends=False)
 
     actual = []
     with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
@@ -49,14 +57,1584 @@ def test_formatting_example():
                 }
             )
 
+    assert_that(
+        utils.apply_text_edits(contents, actual),
+        is_(FORMATTED_TEST_FILE_PATH.read_text()),
+    )
+
+
+def test_formatting_returns_minimal_edits():
+    """Test formatting only replaces the lines that changed."""
+    contents = "import os\n\n\ndef f():\n    return  os.sep\n\n\nx = f()\n"
+
+    with utils.PythonFile(contents, constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
     expected = [
         {
             "range": {
-                "start": {"line": 0, "character": 0},
-                "end": {"line": len(lines), "character": 0},
+                "start": {"line": 4, "character": 0},
+                "end": {"line": 5, "character": 0},
             },
-            "newText": FORMATTED_TEST_FILE_PATH.read_text(),
+            "newText": "    return os.sep\n",
         }
     ]
 
     assert_that(actual, is_(expected))
+
+
+def test_formatting_keeps_crlf_line_endings():
+    """Test formatting a document with CRLF line endings keeps them."""
+    contents = "import sys\r\nprint( x )\r\n"
+    expected = "import sys\r\n\r\nprint(x)\r\n"
+
+    with utils.PythonFile(contents, constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    assert_that(utils.apply_text_edits(contents, actual), is_(expected))
+
+
+def test_range_formatting_only_formats_selection():
+    """Test range formatting leaves code outside the selection untouched."""
+    contents = (
+        "import sys\n"
+        "import os\n"
+        "\n"
+        "\n"
+        "def f(a,b):\n"
+        "    return  a\n"
+        "\n"
+        "\n"
+        "def g(a,b):\n"
+        "    return  b\n"
+    )
+
+    with utils.PythonFile(contents, constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_range_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "range": {
+                        "start": {"line": 8, "character": 0},
+                        "end": {"line": 10, "character": 0},
+                    },
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    assert_that(
+        utils.apply_text_edits(contents, actual),
+        is_(
+            contents.replace("def g(a,b):\n    return  b", "def g(a, b):\n    return b")
+        ),
+    )
+
+
+def test_formatting_unchanged_source_uses_cache():
+    """Test formatting the same source twice reuses the cached result."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    messages = []
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            results = [
+                ls_session.text_document_formatting(
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    }
+                )
+                for _ in range(2)
+            ]
+
+    assert_that(results[1], is_(results[0]))
+    assert_that(messages.count("formatting result from cache"), is_(1))
+
+
+def test_tool_versions_logged_once():
+    """Test the tools are loaded, and their versions logged, once per server."""
+    contents = [f"import sys\nprint( {index} )\n" for index in range(3)]
+
+    messages = []
+    with utils.PythonFile(contents[0], constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents[0],
+                    }
+                }
+            )
+            results = []
+            for version, text in enumerate(contents, start=1):
+                if version > 1:
+                    ls_session.notify_did_change(
+                        {
+                            "textDocument": {"uri": uri, "version": version},
+                            "contentChanges": [{"text": text}],
+                        }
+                    )
+                results.append(
+                    ls_session.text_document_formatting(
+                        {
+                            "textDocument": {"uri": uri},
+                            "options": {"tabSize": 4, "insertSpaces": True},
+                        }
+                    )
+                )
+
+    for index, (text, result) in enumerate(zip(contents, results)):
+        assert_that(
+            utils.apply_text_edits(text, result),
+            is_(f"import sys\n\nprint({index})\n"),
+        )
+    assert_that(messages.count("formatting in-process"), is_(3))
+    assert_that(len([m for m in messages if m.startswith("active versions:")]), is_(1))
+
+
+def test_formatting_after_config_change():
+    """Test formatting picks up pyproject.toml changes reported by the client."""
+    contents = "def f(argument_one, argument_two, argument_three): pass\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        pyproject = root / "pyproject.toml"
+        pyproject.write_text("[tool.black]\nline-length = 88\n")
+        document = root / "sample.py"
+        document.write_text(contents)
+        uri = utils.as_uri(str(document))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            params = {
+                "textDocument": {"uri": uri},
+                "options": {"tabSize": 4, "insertSpaces": True},
+            }
+            before = ls_session.text_document_formatting(params)
+
+            pyproject.write_text("[tool.black]\nline-length = 40\n")
+            ls_session.notify_did_change_watched_files(
+                {"changes": [{"uri": utils.as_uri(str(pyproject)), "type": 2}]}
+            )
+            after = ls_session.text_document_formatting(params)
+
+    assert_that(
+        utils.apply_text_edits(contents, before),
+        is_("def f(argument_one, argument_two, argument_three):\n    pass\n"),
+    )
+    assert_that(
+        utils.apply_text_edits(contents, after),
+        is_(
+            "def f(\n    argument_one,\n    argument_two,\n    argument_three,\n):\n    pass\n"
+        ),
+    )
+
+
+def test_formatting_after_config_change_without_file_watching():
+    """Test formatting picks up pyproject.toml changes if the client can't watch files."""
+    contents = "def f(argument_one, argument_two, argument_three): pass\n"
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    del initialize_params["capabilities"]["workspace"]["didChangeWatchedFiles"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        pyproject = root / "pyproject.toml"
+        pyproject.write_text("[tool.black]\nline-length = 120\n")
+        document = root / "sample.py"
+        document.write_text(contents)
+        uri = utils.as_uri(str(document))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            params = {
+                "textDocument": {"uri": uri},
+                "options": {"tabSize": 4, "insertSpaces": True},
+            }
+            before = ls_session.text_document_formatting(params)
+
+            pyproject.write_text("[tool.black]\nline-length = 40\n")
+            after = ls_session.text_document_formatting(params)
+
+    assert_that(
+        utils.apply_text_edits(contents, before),
+        is_("def f(argument_one, argument_two, argument_three):\n    pass\n"),
+    )
+    assert_that(
+        utils.apply_text_edits(contents, after),
+        is_(
+            "def f(\n    argument_one,\n    argument_two,\n    argument_three,\n):\n    pass\n"
+        ),
+    )
+
+
+def test_formatting_reuses_disk_cache_across_servers(monkeypatch):
+    """Test a new server reuses formatting results cached on disk by an earlier one."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    initialize_params["initializationOptions"]["settings"][0]["diskCacheSize"] = 1
+
+    results = []
+    messages = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        monkeypatch.setenv("XDG_CACHE_HOME", cache_dir)
+        with utils.PythonFile(
+            contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()
+        ) as pf:
+            uri = utils.as_uri(str(pf))
+
+            for _ in range(2):
+                with session.LspSession() as ls_session:
+                    ls_session.set_notification_callback(
+                        session.WINDOW_LOG_MESSAGE,
+                        lambda params: messages.append(params["message"]),
+                    )
+                    ls_session.initialize(initialize_params)
+                    ls_session.notify_did_open(
+                        {
+                            "textDocument": {
+                                "uri": uri,
+                                "languageId": "python",
+                                "version": 1,
+                                "text": contents,
+                            }
+                        }
+                    )
+                    results.append(
+                        ls_session.text_document_formatting(
+                            {
+                                "textDocument": {"uri": uri},
+                                "options": {"tabSize": 4, "insertSpaces": True},
+                            }
+                        )
+                    )
+                    stats = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    assert_that(utils.apply_text_edits(contents, results[0]), is_(expected))
+    assert_that(results[1], is_(results[0]))
+    assert_that(messages.count("formatting result from disk cache"), is_(1))
+    assert_that(stats["caches"]["disk"]["hits"], is_(1))
+
+
+def test_initialize_warms_up_formatters():
+    """Test the server warms up the in-process formatters after initialize."""
+    messages = []
+    with session.LspSession() as ls_session:
+        ls_session.set_notification_callback(
+            session.WINDOW_LOG_MESSAGE,
+            lambda params: messages.append(params["message"]),
+        )
+        ls_session.initialize()
+        ls_session.notify_did_open(
+            {
+                "textDocument": {
+                    "uri": TEST_FILE_URI,
+                    "languageId": "python",
+                    "version": 1,
+                    "text": TEST_FILE_PATH.read_text(),
+                }
+            }
+        )
+        actual = ls_session.text_document_formatting(
+            {
+                "textDocument": {"uri": TEST_FILE_URI},
+                "options": {"tabSize": 4, "insertSpaces": True},
+            }
+        )
+
+    assert_that(actual, is_(None))
+    assert_that("warm-up complete" in messages, is_(True))
+
+
+def test_concurrent_formatting_requests_share_result():
+    """Test concurrent formatting requests for one document get the same edits."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    messages = []
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            futures = [
+                ls_session.send_request(
+                    "textDocument/formatting",
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    },
+                )
+                for _ in range(3)
+            ]
+            results = [future.result(TIMEOUT) for future in futures]
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    for result in results:
+        assert_that(utils.apply_text_edits(contents, result), is_(expected))
+    # The first request formats while the tools warm up, the others wait on it.
+    assert_that(messages.count("formatting in-process"), is_(1))
+    assert_that(messages.count("waiting on pending formatting request"), is_(2))
+
+
+def test_cancelled_formatting_request_is_not_run():
+    """Test a formatting request cancelled before it starts gets RequestCancelled."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    messages = []
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+        params = {
+            "textDocument": {"uri": uri},
+            "options": {"tabSize": 4, "insertSpaces": True},
+        }
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            # The server runs 5 requests at a time, and these all wait on the
+            # first while the tools warm up, so the last one is left queued.
+            futures = [
+                ls_session.send_request("textDocument/formatting", params)
+                for _ in range(6)
+            ]
+            ls_session.cancel_request(futures[-1])
+            results = [future.result(TIMEOUT) for future in futures[:-1]]
+            try:
+                futures[-1].result(TIMEOUT)
+                error_code = None
+            except JsonRpcException as e:
+                error_code = e.code
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    for result in results:
+        assert_that(utils.apply_text_edits(contents, result), is_(expected))
+    assert_that(error_code, is_(JsonRpcRequestCancelled.CODE))
+    assert_that(messages.count("waiting on pending formatting request"), is_(4))
+
+
+def test_concurrent_formatting_requests_for_different_documents():
+    """Test concurrent formatting requests for several documents all succeed."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        uris = []
+        for index in range(8):
+            document = root / f"sample{index}.py"
+            document.write_text(contents)
+            uris.append(utils.as_uri(str(document)))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            for uri in uris:
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": contents,
+                        }
+                    }
+                )
+            futures = [
+                ls_session.send_request(
+                    "textDocument/formatting",
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    },
+                )
+                for uri in uris
+            ]
+            results = [future.result(TIMEOUT) for future in futures]
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    for result in results:
+        assert_that(utils.apply_text_edits(contents, result), is_(expected))
+
+
+def test_concurrent_formatting_requests_over_rpc(monkeypatch):
+    """Test concurrent formatting requests sharing a runner get their own results."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        # A different path to this interpreter makes the server use a runner.
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["interpreter"] = [str(interpreter)]
+
+        contents = {}
+        for index in range(8):
+            document = root / f"sample{index}.py"
+            contents[utils.as_uri(str(document))] = f"import sys;print({index})"
+            document.write_text(contents[utils.as_uri(str(document))])
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            for uri, text in contents.items():
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": text,
+                        }
+                    }
+                )
+            futures = [
+                ls_session.send_request(
+                    "textDocument/formatting",
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    },
+                )
+                for uri in contents
+            ]
+            results = [future.result(TIMEOUT) for future in futures]
+
+    for index, (text, result) in enumerate(zip(contents.values(), results)):
+        assert_that(
+            utils.apply_text_edits(text, result),
+            is_(f"import sys\n\nprint({index})\n"),
+        )
+
+
+def test_formatting_over_rpc_keeps_source_bytes(monkeypatch):
+    """Test sources sent to a runner as raw bytes come back unchanged."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+    line = 'x = ["é\\\\n", "\\u2603", "日本", \'"quoted"\']\n'
+    contents = "import sys\nimport os\n" + line * 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+        document = root / "sample.py"
+        document.write_text(contents, encoding="utf-8")
+        uri = utils.as_uri(str(document))
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["interpreter"] = [str(interpreter)]
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            results = [
+                ls_session.text_document_formatting(
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    }
+                )
+                # The first request may go out before the runner picks the
+                # binary protocol, later ones are sent with it.
+                for _ in range(2)
+            ]
+
+    expected = "import os\nimport sys\n\n" + line * 200
+    for result in results:
+        assert_that(utils.apply_text_edits(contents, result), is_(expected))
+
+
+def test_workspaces_share_runners_for_the_same_interpreter(monkeypatch):
+    """Test workspace folders using the same interpreter share its runners."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        first_settings = initialize_params["initializationOptions"]["settings"][0]
+        first_settings["interpreter"] = [str(interpreter)]
+        first_settings["maxRunners"] = 1
+        folders = []
+        for name in ("first", "second"):
+            folder = root / name
+            folder.mkdir()
+            folders.append(folder)
+        first_settings["workspace"] = utils.as_uri(str(folders[0]))
+        second_settings = copy.deepcopy(first_settings)
+        second_settings["workspace"] = utils.as_uri(str(folders[1]))
+        initialize_params["initializationOptions"]["settings"].append(second_settings)
+
+        results = []
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            for folder in folders:
+                uri = utils.as_uri(str(folder / "sample.py"))
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": "import sys;print(1)",
+                        }
+                    }
+                )
+                results.append(
+                    ls_session.text_document_formatting(
+                        {
+                            "textDocument": {"uri": uri},
+                            "options": {"tabSize": 4, "insertSpaces": True},
+                        }
+                    )
+                )
+            stats = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+
+    for result in results:
+        assert_that(
+            utils.apply_text_edits("import sys;print(1)", result),
+            is_("import sys\n\nprint(1)\n"),
+        )
+    runners = stats["runners"][str(interpreter)]
+    assert_that(list(stats["runners"]), is_([str(interpreter)]))
+    assert_that(runners["runners"], is_(1))
+    assert_that(runners["inFlight"], is_(0))
+
+
+def test_runners_are_recycled_after_max_requests(monkeypatch):
+    """Test runners are replaced after too many requests without failing any."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["interpreter"] = [str(interpreter)]
+        settings["maxRunnerRequests"] = 2
+
+        contents = {}
+        for index in range(6):
+            document = root / f"sample{index}.py"
+            contents[utils.as_uri(str(document))] = f"import sys;print({index})"
+            document.write_text(contents[utils.as_uri(str(document))])
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            results = []
+            for uri, text in contents.items():
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": text,
+                        }
+                    }
+                )
+                results.append(
+                    ls_session.text_document_formatting(
+                        {
+                            "textDocument": {"uri": uri},
+                            "options": {"tabSize": 4, "insertSpaces": True},
+                        }
+                    )
+                )
+            # Worn out runners serve until their replacement is ready, and
+            # then stop, leaving just the replacement.
+            deadline = time.monotonic() + TIMEOUT
+            while True:
+                stats = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+                runners = stats["runners"][str(interpreter)]
+                if runners["runners"] == runners["ready"] == 1:
+                    break
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+
+    for index, (text, result) in enumerate(zip(contents.values(), results)):
+        assert_that(
+            utils.apply_text_edits(text, result),
+            is_(f"import sys\n\nprint({index})\n"),
+        )
+    assert_that(runners["recycled"] >= 1, is_(True))
+    assert_that(runners["runners"], is_(1))
+    assert_that(runners["ready"], is_(1))
+
+
+def test_runners_start_and_report_ready_at_initialize(monkeypatch):
+    """Test runners for other interpreters are started and ready before formatting."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["interpreter"] = [str(interpreter)]
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            deadline = time.monotonic() + TIMEOUT
+            while True:
+                stats = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+                runners = stats["runners"].get(str(interpreter), {})
+                if runners.get("ready") or time.monotonic() > deadline:
+                    break
+                time.sleep(0.1)
+
+    assert_that(runners["ready"], is_(1))
+    assert_that(runners["inFlight"], is_(0))
+    assert_that(sorted(runners["versions"]), is_(["black", "libcst", "ufmt", "usort"]))
+
+
+def test_formatting_in_process_pool():
+    """Test formatting on worker processes when using the process pool."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = initialize_params["initializationOptions"]["settings"][0]
+    settings["executionMode"] = "processPool"
+    settings["processPoolSize"] = 1
+
+    messages = []
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    assert_that(utils.apply_text_edits(contents, actual), is_(expected))
+    assert_that("formatting in process pool" in messages, is_(True))
+
+
+def test_process_pool_workers_are_recycled_after_max_requests():
+    """Test process pool workers are replaced after too many formats."""
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = initialize_params["initializationOptions"]["settings"][0]
+    settings["executionMode"] = "processPool"
+    settings["processPoolSize"] = 1
+    settings["maxRunnerRequests"] = 1
+
+    messages = []
+    results = []
+    with utils.PythonFile("", constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize(initialize_params)
+            for version in range(1, 4):
+                text = f"import sys;print({version})"
+                if version == 1:
+                    ls_session.notify_did_open(
+                        {
+                            "textDocument": {
+                                "uri": uri,
+                                "languageId": "python",
+                                "version": version,
+                                "text": text,
+                            }
+                        }
+                    )
+                else:
+                    ls_session.notify_did_change(
+                        {
+                            "textDocument": {"uri": uri, "version": version},
+                            "contentChanges": [{"text": text}],
+                        }
+                    )
+                result = ls_session.text_document_formatting(
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    }
+                )
+                results.append(utils.apply_text_edits(text, result))
+
+    assert_that(
+        results,
+        is_([f"import sys\n\nprint({version})\n" for version in range(1, 4)]),
+    )
+    assert_that("recycling process pool workers" in messages, is_(True))
+
+
+def test_process_pool_workers_exit_with_server():
+    """Test the process pool workers exit when the server shuts down."""
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = initialize_params["initializationOptions"]["settings"][0]
+    settings["executionMode"] = "processPool"
+    settings["processPoolSize"] = 1
+
+    pids = []
+    worker_ready = Event()
+
+    def _handle_log(params):
+        match = re.fullmatch(r"process pool worker (\d+) ready", params["message"])
+        if match:
+            pids.append(int(match.group(1)))
+            worker_ready.set()
+
+    with session.LspSession() as ls_session:
+        ls_session.set_notification_callback(session.WINDOW_LOG_MESSAGE, _handle_log)
+        ls_session.initialize(initialize_params)
+        assert_that(worker_ready.wait(TIMEOUT), is_(True))
+
+        ls_session.send_request("shutdown").result(TIMEOUT)
+        ls_session.exit_lsp(TIMEOUT)
+
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    deadline = time.monotonic() + TIMEOUT
+    while any(_is_running(pid) for pid in pids) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert_that(any(_is_running(pid) for pid in pids), is_(False))
+
+
+def test_settings_change_applies_without_restart():
+    """Test settings sent with didChangeConfiguration apply to the running server."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = copy.deepcopy(initialize_params["initializationOptions"]["settings"])
+    settings[0]["executionMode"] = "processPool"
+    settings[0]["processPoolSize"] = 1
+
+    messages = []
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            formatting_params = {
+                "textDocument": {"uri": uri},
+                "options": {"tabSize": 4, "insertSpaces": True},
+            }
+            before = ls_session.text_document_formatting(formatting_params)
+
+            ls_session.notify_did_change_configuration({"settings": settings})
+            after = ls_session.text_document_formatting(formatting_params)
+
+    assert_that(utils.apply_text_edits(contents, before), is_(expected))
+    assert_that(utils.apply_text_edits(contents, after), is_(expected))
+    assert_that(
+        "settings changed: executionMode, processPoolSize" in messages, is_(True)
+    )
+    assert_that(
+        messages.index("formatting in-process")
+        < messages.index("formatting in process pool"),
+        is_(True),
+    )
+
+
+def test_stats_request_reports_formatting_latency():
+    """Test ufmt/stats reports latency and cache use after formatting."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            for _ in range(2):
+                ls_session.text_document_formatting(
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    }
+                )
+            actual = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+
+    latency = actual["latency"]["in-process"]
+    assert_that(latency["total"]["count"], is_(2))
+    assert_that(latency["format"]["count"], is_(2))
+    assert_that(latency["resolveConfig"]["count"], is_(2))
+    assert_that(
+        latency["total"]["p50"] <= latency["total"]["p95"] <= latency["total"]["p99"],
+        is_(True),
+    )
+    assert_that(actual["caches"]["format"]["hitRate"], is_(0.5))
+    # The first request resolves the config for the document's directory.
+    assert_that(actual["caches"]["config"]["hitRate"], is_(0.5))
+
+
+def test_formatting_notebook_cells_in_one_batch():
+    """Test cells of a notebook are formatted together, and only when changed."""
+    notebook_path = constants.TEST_DATA / "sample1" / "notebook.ipynb"
+    notebook_uri = utils.as_uri(str(notebook_path))
+    cells = {
+        f"vscode-notebook-cell:{notebook_path.as_posix()}#C{index}": source
+        for index, source in enumerate(
+            ["import sys\nimport os", "print( sys )", "x = 1", "y=[1,2]"]
+        )
+    }
+    cell_uris = list(cells)
+
+    messages = []
+    with session.LspSession() as ls_session:
+        ls_session.set_notification_callback(
+            session.WINDOW_LOG_MESSAGE,
+            lambda params: messages.append(params["message"]),
+        )
+        ls_session.initialize()
+        ls_session.notify_did_open_notebook(
+            {
+                "notebookDocument": {
+                    "uri": notebook_uri,
+                    "notebookType": "jupyter-notebook",
+                    "version": 1,
+                    "cells": [{"kind": 2, "document": uri} for uri in cell_uris],
+                },
+                "cellTextDocuments": [
+                    {"uri": uri, "languageId": "python", "version": 1, "text": text}
+                    for uri, text in cells.items()
+                ],
+            }
+        )
+
+        def _format(uri):
+            return ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+        actual = {uri: _format(uri) for uri in cell_uris}
+
+        ls_session.notify_did_change_notebook(
+            {
+                "notebookDocument": {"uri": notebook_uri, "version": 2},
+                "change": {
+                    "cells": {
+                        "textContent": [
+                            {
+                                "document": {"uri": cell_uris[2], "version": 2},
+                                "changes": [{"text": "x=2"}],
+                            }
+                        ]
+                    }
+                },
+            }
+        )
+        changed = _format(cell_uris[2])
+
+    formatted = {
+        uri: utils.apply_text_edits(cells[uri], edits or [])
+        for uri, edits in actual.items()
+    }
+    assert_that(
+        list(formatted.values()),
+        is_(["import os\nimport sys", "print(sys)", "x = 1", "y = [1, 2]"]),
+    )
+    assert_that(utils.apply_text_edits("x=2", changed), is_("x = 2"))
+
+    batches = [m for m in messages if re.fullmatch(r"formatting \d+ of \d+ .*", m)]
+    assert_that(
+        batches,
+        is_(["formatting 4 of 4 notebook cells", "formatting 1 of 4 notebook cells"]),
+    )
+
+
+def test_formatting_reuses_sort_and_format_stages():
+    """Test edits to only the code or only the imports reuse the other stage."""
+    contents = [
+        "import sys\nimport os\n\nprint( sys, os )\n",
+        # Only the code changed, so the sorted imports are reused.
+        "import sys\nimport os\n\nprint( os, sys )\n",
+        # Only the import order changed, so the formatted code is reused.
+        "import os\nimport sys\n\nprint( os, sys )\n",
+    ]
+
+    actual = []
+    with utils.PythonFile(contents[0], constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize()
+            for version, text in enumerate(contents, start=1):
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": version,
+                            "text": text,
+                        }
+                    }
+                )
+                actual.append(
+                    ls_session.text_document_formatting(
+                        {
+                            "textDocument": {"uri": uri},
+                            "options": {"tabSize": 4, "insertSpaces": True},
+                        }
+                    )
+                )
+            stats = ls_session.send_request("ufmt/stats", {}).result(TIMEOUT)
+
+    assert_that(
+        [utils.apply_text_edits(text, edits) for text, edits in zip(contents, actual)],
+        is_(
+            [
+                "import os\nimport sys\n\nprint(sys, os)\n",
+                "import os\nimport sys\n\nprint(os, sys)\n",
+                "import os\nimport sys\n\nprint(os, sys)\n",
+            ]
+        ),
+    )
+    assert_that(stats["caches"]["sort"]["hits"], is_(1))
+    assert_that(stats["caches"]["formatter"]["hits"], is_(1))
+
+
+def test_auto_engine_formats_large_documents_with_ruff_api():
+    """Test the auto engine formats documents too large for black with ruff-api."""
+    contents = "x = [1,2,3]\n" * 50000
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    initialize_params["initializationOptions"]["settings"][0]["engine"] = "auto"
+
+    messages = []
+    with utils.PythonFile("", constants.TEST_DATA / "sample1") as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    assert_that(
+        utils.apply_text_edits(contents, actual), is_("x = [1, 2, 3]\n" * 50000)
+    )
+    assert_that(
+        f"formatting {len(contents)} bytes with ruff-api" in messages, is_(True)
+    )
+
+
+def test_formatting_over_deadline_applies_edits_later():
+    """Test formatting past its deadline returns nothing and applies edits later."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    # Formatting waits for the warm-up, so the first request always overruns.
+    initialize_params["initializationOptions"]["settings"][0]["formatDeadline"] = 1
+
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+            deadline = time.monotonic() + TIMEOUT
+            while not ls_session.applied_edits and time.monotonic() < deadline:
+                time.sleep(0.1)
+
+    assert_that(actual, is_(None))
+    assert_that(len(ls_session.applied_edits), is_(1))
+    (document_edit,) = ls_session.applied_edits[0]["documentChanges"]
+    assert_that(document_edit["textDocument"], is_({"uri": uri, "version": 1}))
+    assert_that(
+        utils.apply_text_edits(contents, document_edit["edits"]),
+        is_(UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()),
+    )
+
+
+def test_format_workspace():
+    """Test formatting a workspace folder, skipping files excluded by ufmt."""
+    unformatted = "import sys\nprint( x )\n"
+    formatted = "import sys\n\nprint(x)\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        (root / "pyproject.toml").write_text('[tool.ufmt]\nexcludes = ["excluded/"]\n')
+        (root / "excluded").mkdir()
+        (root / "excluded" / "skipped.py").write_text(unformatted)
+        (root / "package").mkdir()
+        for name in ("a.py", "package/b.py"):
+            (root / name).write_text(unformatted)
+        (root / "clean.py").write_text(formatted)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        initialize_params["rootUri"] = utils.as_uri(str(root))
+        initialize_params["workspaceFolders"] = [
+            {"uri": utils.as_uri(str(root)), "name": "workspace"}
+        ]
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["workspace"] = utils.as_uri(str(root))
+
+        progress = []
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.PROGRESS, lambda params: progress.append(params["value"])
+            )
+            ls_session.initialize(initialize_params)
+            actual = ls_session.send_request("ufmt/formatWorkspace", {}).result(TIMEOUT)
+            applied_edits = ls_session.applied_edits
+
+        changed = {}
+        for edit in applied_edits:
+            for document_edit in edit["documentChanges"]:
+                uri = document_edit["textDocument"]["uri"]
+                changed[uri] = utils.apply_text_edits(
+                    unformatted, document_edit["edits"]
+                )
+
+    assert_that(actual, is_({"files": 3, "changed": 2, "failed": 0}))
+    assert_that(
+        changed,
+        is_(
+            {
+                utils.as_uri(str(root / "a.py")): formatted,
+                utils.as_uri(str(root / "package" / "b.py")): formatted,
+            }
+        ),
+    )
+    assert_that(progress[0]["kind"], is_("begin"))
+    assert_that(progress[-1]["kind"], is_("end"))
+
+
+def test_format_workspace_over_rpc_in_batches(monkeypatch):
+    """Test formatting a workspace using another interpreter sends batches."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+    unformatted = "import sys\nprint( x )\n"
+    formatted = "import sys\n\nprint(x)\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        interpreter = root / "python"
+        interpreter.symlink_to(sys.executable)
+        (root / "package").mkdir()
+        (root / "package" / "pyproject.toml").write_text(
+            "[tool.black]\nline-length = 88\n"
+        )
+        names = [f"a{index}.py" for index in range(3)]
+        names += [f"package/b{index}.py" for index in range(3)]
+        for name in names:
+            (root / name).write_text(unformatted)
+        (root / "broken.py").write_text("x = (\n")
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        initialize_params["rootUri"] = utils.as_uri(str(root))
+        initialize_params["workspaceFolders"] = [
+            {"uri": utils.as_uri(str(root)), "name": "workspace"}
+        ]
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["workspace"] = utils.as_uri(str(root))
+        settings["interpreter"] = [str(interpreter)]
+
+        messages = []
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE,
+                lambda params: messages.append(params["message"]),
+            )
+            ls_session.initialize(initialize_params)
+            actual = ls_session.send_request("ufmt/formatWorkspace", {}).result(TIMEOUT)
+            applied_edits = ls_session.applied_edits
+
+        changed = {}
+        for edit in applied_edits:
+            for document_edit in edit["documentChanges"]:
+                uri = document_edit["textDocument"]["uri"]
+                changed[uri] = utils.apply_text_edits(
+                    unformatted, document_edit["edits"]
+                )
+
+    assert_that(actual, is_({"files": 7, "changed": 6, "failed": 1}))
+    assert_that(
+        changed,
+        is_({utils.as_uri(str(root / name)): formatted for name in names}),
+    )
+    assert_that("formatting 7 files via rpc" in messages, is_(True))
+    assert_that("formatting via rpc" in messages, is_(False))
+
+
+def test_format_workspace_over_rpc_keeps_first_party_per_document(monkeypatch):
+    """Test documents batched together each sort their own package first-party."""
+    monkeypatch.setenv("LS_IMPORT_STRATEGY", "fromEnvironment")
+    unformatted = "import pkg_a\nimport pkg_b\nimport zzz\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        interpreter = pathlib.Path(tmp).resolve() / "python"
+        interpreter.symlink_to(sys.executable)
+        root = pathlib.Path(tmp).resolve() / "workspace"
+        root.mkdir()
+        (root / "pyproject.toml").write_text("[tool.black]\nline-length = 88\n")
+        names = ["pkg_a/mod.py", "pkg_b/mod.py"]
+        for name in names:
+            (root / name).parent.mkdir()
+            (root / name).parent.joinpath("__init__.py").write_text("")
+            (root / name).write_text(unformatted)
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        initialize_params["rootUri"] = utils.as_uri(str(root))
+        initialize_params["workspaceFolders"] = [
+            {"uri": utils.as_uri(str(root)), "name": "workspace"}
+        ]
+        settings = initialize_params["initializationOptions"]["settings"][0]
+        settings["workspace"] = utils.as_uri(str(root))
+        settings["interpreter"] = [str(interpreter)]
+
+        single = {}
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            ls_session.send_request("ufmt/formatWorkspace", {}).result(TIMEOUT)
+            applied_edits = ls_session.applied_edits
+            for name in names:
+                uri = utils.as_uri(str(root / name))
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": unformatted,
+                        }
+                    }
+                )
+                single[uri] = utils.apply_text_edits(
+                    unformatted,
+                    ls_session.text_document_formatting(
+                        {
+                            "textDocument": {"uri": uri},
+                            "options": {"tabSize": 4, "insertSpaces": True},
+                        }
+                    ),
+                )
+
+        batched = {}
+        for edit in applied_edits:
+            for document_edit in edit["documentChanges"]:
+                uri = document_edit["textDocument"]["uri"]
+                batched[uri] = utils.apply_text_edits(
+                    unformatted, document_edit["edits"]
+                )
+
+    assert_that(batched, is_(single))
+    assert_that(
+        batched,
+        is_(
+            {
+                utils.as_uri(str(root / "pkg_a/mod.py")): (
+                    "import pkg_b\nimport zzz\n\nimport pkg_a\n"
+                ),
+                utils.as_uri(str(root / "pkg_b/mod.py")): (
+                    "import pkg_a\nimport zzz\n\nimport pkg_b\n"
+                ),
+            }
+        ),
+    )
+
+
+def test_formatting_returns_preformatted_edits():
+    """Test formatting returns edits pre-formatted in the background."""
+    UNFORMATTED_TEST_FILE_PATH = constants.TEST_DATA / "sample1" / "sample.unformatted"
+
+    contents = UNFORMATTED_TEST_FILE_PATH.read_text()
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = initialize_params["initializationOptions"]["settings"][0]
+    settings["preformat"] = True
+
+    messages = []
+    preformatted = Event()
+
+    def _handle_log(params):
+        messages.append(params["message"])
+        if params["message"].startswith("pre-formatted version 2 "):
+            preformatted.set()
+
+    with utils.PythonFile(contents, UNFORMATTED_TEST_FILE_PATH.parent.resolve()) as pf:
+        uri = utils.as_uri(str(pf))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE, _handle_log
+            )
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": "",
+                    }
+                }
+            )
+            ls_session.notify_did_change(
+                {
+                    "textDocument": {"uri": uri, "version": 2},
+                    "contentChanges": [{"text": contents}],
+                }
+            )
+            assert_that(preformatted.wait(TIMEOUT), is_(True))
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    expected = UNFORMATTED_TEST_FILE_PATH.with_suffix(".py").read_text()
+    assert_that(utils.apply_text_edits(contents, actual), is_(expected))
+    assert_that("formatting result from pre-format" in messages, is_(True))
+
+
+@pytest.mark.parametrize("watching", [True, False])
+def test_preformatted_edits_dropped_after_config_change(watching):
+    """Test pre-formatted edits aren't returned once pyproject.toml changes."""
+    contents = "def f(argument_one, argument_two, argument_three): pass\n"
+
+    initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+    settings = initialize_params["initializationOptions"]["settings"][0]
+    settings["preformat"] = True
+    if not watching:
+        del initialize_params["capabilities"]["workspace"]["didChangeWatchedFiles"]
+
+    messages = []
+    preformatted = Event()
+
+    def _handle_log(params):
+        messages.append(params["message"])
+        if params["message"].startswith("pre-formatted version 1 "):
+            preformatted.set()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        pyproject = root / "pyproject.toml"
+        pyproject.write_text("[tool.black]\nline-length = 88\n")
+        document = root / "sample.py"
+        document.write_text(contents)
+        uri = utils.as_uri(str(document))
+
+        with session.LspSession() as ls_session:
+            ls_session.set_notification_callback(
+                session.WINDOW_LOG_MESSAGE, _handle_log
+            )
+            ls_session.initialize(initialize_params)
+            ls_session.notify_did_open(
+                {
+                    "textDocument": {
+                        "uri": uri,
+                        "languageId": "python",
+                        "version": 1,
+                        "text": contents,
+                    }
+                }
+            )
+            assert_that(preformatted.wait(TIMEOUT), is_(True))
+
+            pyproject.write_text("[tool.black]\nline-length = 40\n")
+            if watching:
+                ls_session.notify_did_change_watched_files(
+                    {"changes": [{"uri": utils.as_uri(str(pyproject)), "type": 2}]}
+                )
+            actual = ls_session.text_document_formatting(
+                {
+                    "textDocument": {"uri": uri},
+                    "options": {"tabSize": 4, "insertSpaces": True},
+                }
+            )
+
+    assert_that(
+        utils.apply_text_edits(contents, actual),
+        is_(
+            "def f(\n    argument_one,\n    argument_two,\n    argument_three,\n):\n    pass\n"
+        ),
+    )
+    assert_that("formatting result from pre-format" in messages, is_(False))
+
+
+def test_formatting_uses_innermost_workspace_settings():
+    """Test documents use settings of the innermost workspace folder holding them."""
+    contents = "import os\n\n\ndef f():\n    return  os.sep\n\n\nx = f()\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp).resolve()
+        inner = root / "inner"
+        inner.mkdir()
+
+        initialize_params = copy.deepcopy(defaults.VSCODE_DEFAULT_INITIALIZE)
+        outer_settings = initialize_params["initializationOptions"]["settings"][0]
+        outer_settings["workspace"] = utils.as_uri(str(root))
+        inner_settings = copy.deepcopy(outer_settings)
+        inner_settings["workspace"] = utils.as_uri(str(inner))
+        inner_settings["maxTextEdits"] = 0
+        initialize_params["initializationOptions"]["settings"].append(inner_settings)
+
+        results = {}
+        with session.LspSession() as ls_session:
+            ls_session.initialize(initialize_params)
+            for directory in (root, inner):
+                uri = utils.as_uri(str(directory / "sample.py"))
+                ls_session.notify_did_open(
+                    {
+                        "textDocument": {
+                            "uri": uri,
+                            "languageId": "python",
+                            "version": 1,
+                            "text": contents,
+                        }
+                    }
+                )
+                results[directory] = ls_session.text_document_formatting(
+                    {
+                        "textDocument": {"uri": uri},
+                        "options": {"tabSize": 4, "insertSpaces": True},
+                    }
+                )
+
+    # A limit of zero edits replaces the whole document.
+    assert_that(results[root][0]["range"]["start"]["line"], is_(4))
+    assert_that(results[inner][0]["range"]["start"]["line"], is_(0))
+    assert_that(results[inner][0]["range"]["end"]["line"], is_(8))